@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 """
-Run a OS command on many files. Can also show progress in external file.
+Run a OS command (or a Python function, see --module) on many files. Can also show progress in external file.
 """
 
 __version__ = 230313002152
@@ -15,70 +15,425 @@ __maintainer__ = "Harding"
 __email__ = "not.at.the.moment@example.com"
 __status__ = "Development"
 
-use_natsort = True
-try: # It will function without this sorting
-    import natsort
-except ImportError:
-    use_natsort = False
-    print("WARNING: Module natsort not installed, this module is not required but strongly recommended. pip install natsort")
-
 import os
+import sys
 import time
 import subprocess
+import errno
+import shlex
+import itertools
+import collections
+import concurrent.futures
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Set, Tuple, Union
 import harding_utils as hu
 
-def do_exec(command: str, arg_file: str, arg_index: int, number_of_files: int, started: float, print_progress_to_file: bool = None):
-    if print_progress_to_file:
-        percent_done = arg_index / number_of_files
-        time_elapsed = time.time() - started
-        estimated_total_time = time_elapsed / percent_done
-        with open(print_progress_to_file, "w", encoding='utf8', newline='\n') as fdesc: # TODO: This might be buggy, verify
-            hu.log_print(f"File {arg_index} / {number_of_files} ({percent_done * 100:.3f}%) estimated {(estimated_total_time - time_elapsed + 1)/60:0.0f}m left. Have been running for {time_elapsed:0.0f} seconds. Current file: \"{arg_file}\"",
-                arg_type="PROGRESS",
-                arg_file=fdesc,
-                arg_force_flush=True)
+JOURNAL_COMMIT_EVERY = 1000 # Commit (and fsync) the journal after this many files...
+JOURNAL_COMMIT_SECONDS = 5.0 # ...or this many seconds, whatever comes first. A crash loses at most this much, those files are run again
+
+def journal_open(arg_journal_file: str) -> Dict[str, Any]:
+    ''' Opens (and creates if needed) the SQLite file where every command that is run is saved '''
+    import sqlite3 # Imported here since it's only needed when the journal is used
+
+    l_db = sqlite3.connect(arg_journal_file, timeout=60)
+    l_db.execute("PRAGMA journal_mode=WAL") # Appends to the WAL file instead of rewriting pages
+    l_db.execute("PRAGMA synchronous=FULL") # fsync on every commit, but we only commit every JOURNAL_COMMIT_EVERY files
+    l_db.execute("CREATE TABLE IF NOT EXISTS runs (command TEXT NOT NULL, file TEXT NOT NULL, exit_code INTEGER NOT NULL, seconds REAL NOT NULL, finished REAL NOT NULL)")
+    l_db.execute("CREATE INDEX IF NOT EXISTS runs_command ON runs (command)")
+    return {"db": l_db, "pending": 0, "last_commit": time.monotonic()}
+
+def journal_done_files(arg_journal: Dict[str, Any], arg_command: str) -> Set[str]:
+    ''' The files where arg_command has been run with exit code 0. Loaded once so that each file is checked in O(1) '''
+    return {row[0] for row in arg_journal["db"].execute("SELECT file FROM runs WHERE command = ? AND exit_code = 0", (arg_command,))}
+
+def journal_add(arg_journal: Dict[str, Any], arg_command: str, arg_file: str, arg_exit_code: int, arg_seconds: float) -> None:
+    ''' Saves one finished command. Committed in batches, see JOURNAL_COMMIT_EVERY and JOURNAL_COMMIT_SECONDS '''
+    arg_journal["db"].execute("INSERT INTO runs (command, file, exit_code, seconds, finished) VALUES (?, ?, ?, ?, ?)", (arg_command, arg_file, arg_exit_code, arg_seconds, time.time()))
+    arg_journal["pending"] += 1
+    if arg_journal["pending"] >= JOURNAL_COMMIT_EVERY or time.monotonic() - arg_journal["last_commit"] >= JOURNAL_COMMIT_SECONDS:
+        arg_journal["db"].commit()
+        arg_journal["pending"] = 0
+        arg_journal["last_commit"] = time.monotonic()
+
+def journal_close(arg_journal: Dict[str, Any]) -> None:
+    ''' Commits what is left and closes the SQLite file '''
+    try:
+        arg_journal["db"].commit()
+    finally:
+        arg_journal["db"].close()
+
+class ProgressReporter:
+    ''' Writes the progress to a file at most every arg_interval seconds, or every arg_every files if that is > 0, so the cost does not depend on the number of files.
+        The file is written to a temp file that is renamed, so a reader never sees a half written file.
+        The ETA uses the throughput smoothed with an exponential moving average (arg_smoothing is the weight of the newest measurement)
+    '''
+
+    def __init__(self, arg_progress_file: str, arg_total: int = 0, arg_interval: float = 1.0, arg_every: int = 0, arg_smoothing: float = 0.2):
+        self.progress_file = arg_progress_file
+        self.total = arg_total # 0 means unknown
+        self.interval = arg_interval
+        self.every = arg_every
+        self.smoothing = arg_smoothing
+        self.started = time.monotonic()
+        self._last_time = self.started
+        self._last_done = 0
+        self._rate = 0.0 # Files per second, smoothed
+
+    def update(self, arg_done: int, arg_failed: int, arg_current_file: str, arg_resume_offset: int = -1) -> bool:
+        ''' Called after every file. Returns True if the file was written '''
+        l_now = time.monotonic()
+        if l_now - self._last_time < self.interval and (self.every <= 0 or arg_done - self._last_done < self.every):
+            return False
+        self.write(arg_done, arg_failed, arg_current_file, arg_resume_offset, l_now)
+        return True
+
+    def write(self, arg_done: int, arg_failed: int, arg_current_file: str, arg_resume_offset: int = -1, arg_now: float = 0.0) -> None:
+        ''' Writes the progress file now. arg_resume_offset is the byte offset in the file list where the first file that is not done yet starts, -1 means unknown '''
+        l_now = arg_now or time.monotonic()
+        if l_now > self._last_time and arg_done > self._last_done:
+            l_rate = (arg_done - self._last_done) / (l_now - self._last_time)
+            self._rate = l_rate if 0.0 == self._rate else self.smoothing * l_rate + (1.0 - self.smoothing) * self._rate
+        self._last_time = l_now
+        self._last_done = arg_done
+
+        l_elapsed = l_now - self.started
+        if self.total:
+            progress_line = f"File {arg_done} / {self.total} ({arg_done / self.total * 100:.3f}%)"
+            if self._rate > 0:
+                progress_line += f" estimated {(self.total - arg_done) / self._rate / 60:0.0f}m left."
+        else: # We are still looking for files so we don't know how many there are
+            progress_line = f"File {arg_done} / ?"
+        progress_line += f" {self._rate:0.2f} files/s, {arg_failed} failed."
+        if arg_resume_offset >= 0:
+            progress_line += f" Resume with --offset {arg_resume_offset}"
+
+        l_tmp_file = self.progress_file + ".tmp"
+        with open(l_tmp_file, "w", encoding='utf8', newline='\n') as fdesc:
+            fdesc.write(hu.timestamped_line(f"PROGRESS: {progress_line} Have been running for {l_elapsed:0.0f} seconds. Current file: \"{arg_current_file}\"\n"))
+        os.replace(l_tmp_file, self.progress_file)
+
+def files_to_work_on(arg_files: Iterable[str], arg_file_list: bool = False, arg_only_basename: bool = False, arg_offset: int = 0, arg_line_offsets: Union[collections.deque, None] = None, arg_skip: Union[Set[str], None] = None) -> Iterator[str]:
+    ''' Yields the filenames to run the command on. If arg_file_list or the file is - then the non-empty lines in the file are yielded instead.
+        The lines are read lazily, starting at byte offset arg_offset in the first file list.
+        If arg_line_offsets is given then the byte offset of each line that is yielded is appended to it. Files in arg_skip are not yielded
+    '''
+    for file in arg_files:
+        if arg_only_basename:
+            file = os.path.basename(file)
+        if arg_file_list or "-" == file:
+            for offset, line in hu.text_iter_lines(file, arg_offset, arg_with_offsets=True):
+                if arg_skip and line in arg_skip:
+                    continue
+                if arg_line_offsets is not None:
+                    arg_line_offsets.append(offset)
+                yield line
+            arg_offset = 0
+        elif not arg_skip or file not in arg_skip:
+            yield file
+
+def split_command(arg_command: str) -> List[str]:
+    ''' Splits the command into an argv template for command_argv(). On Windows \\ is not an escape char (paths) and the quotes around each argument are removed,
+        otherwise subprocess.list2cmdline() would quote them again
+    '''
+    if os.name != "nt":
+        return shlex.split(arg_command)
+    res: List[str] = []
+    for arg in shlex.split(arg_command, posix=False):
+        if len(arg) >= 2 and arg[0] == arg[-1] and arg[0] in "\"'":
+            arg = arg[1:-1]
+        res.append(arg)
+    return res
+
+def command_argv(arg_template: List[str], arg_files: List[str]) -> List[str]:
+    ''' The argv to run without a shell. An argument that is exactly %file becomes one argument per file, in other arguments %file is replaced with the file.
+        If %file is not in the template then the files are added last, like xargs
+    '''
+    if not any("%file" in arg for arg in arg_template):
+        return arg_template + arg_files
+    res: List[str] = []
+    for arg in arg_template:
+        if "%file" == arg:
+            res.extend(arg_files)
+        elif "%file" in arg:
+            if 1 != len(arg_files):
+                raise ValueError(f'"{arg}" can only be used with one file at a time, use %file as its own argument')
+            res.append(arg.replace("%file", arg_files[0]))
+        else:
+            res.append(arg)
+    return res
+
+def exec_command(arg_command: Union[str, List[str]], arg_file: Union[str, List[str]], arg_capture_output: bool = False) -> Tuple[int, bytes, float]:
+    ''' Run the command on one file, or on many files at once if arg_command is an argv template (see command_argv()).
+        A str command is run by the shell, an argv template is run directly without a shell.
+        Returns the exit code, the output (only if arg_capture_output) and how many seconds it took.
+        If the program cannot be started the exit code is the same as from a shell: 127 if it is not found and 126 otherwise.
+        Raises OSError with errno.E2BIG if the files do not fit in one command line, so the caller can split them
+    '''
+    l_files = [arg_file] if isinstance(arg_file, str) else arg_file
+    if isinstance(arg_command, str):
+        if 1 != len(l_files):
+            raise ValueError("A shell command can only be run on one file at a time, use an argv template")
+        command: Union[str, List[str]] = arg_command.replace("%file", l_files[0])
+    else:
+        command = command_argv(arg_command, l_files)
+    l_shell = isinstance(command, str)
+    started = time.monotonic()
+    try:
+        if not arg_capture_output:
+            return subprocess.call(command, shell=l_shell), b"", time.monotonic() - started
+        res = subprocess.run(command, shell=l_shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
+    except OSError as err: # Only without a shell, the shell itself reports these with 127 and 126
+        if errno.E2BIG == err.errno and len(l_files) > 1:
+            raise
+        l_message = f"{command[0] if isinstance(command, list) else command}: {err.strerror or err}\n"
+        if not arg_capture_output:
+            sys.stderr.write(l_message)
+            sys.stderr.flush()
+        return (127 if errno.ENOENT == err.errno else 126), (l_message.encode("utf-8", errors="backslashreplace") if arg_capture_output else b""), time.monotonic() - started
+    return res.returncode, res.stdout, time.monotonic() - started
+
+def _run_many(arg_run: Callable[[List[str]], List[Tuple[int, Any, float]]], arg_files: Iterable[str], arg_pool: Union[concurrent.futures.Executor, None], arg_jobs: int, arg_batch: int, arg_keep_order: bool) -> Iterator[Tuple[int, str, int, Any, float]]:
+    ''' Internal function. Gives arg_run() up to arg_batch files at a time, in arg_pool if it is not None, and yields (index, file, exit code, output, seconds) for each file.
+        arg_run() returns (exit code, output, seconds) for each file it was given
+    '''
+    l_items = enumerate(arg_files, 1)
+    l_batches = iter(lambda: list(itertools.islice(l_items, max(1, arg_batch))), [])
+
+    def _results(arg_batch_items: List[Tuple[int, str]], arg_batch_results: List[Tuple[int, Any, float]]) -> Iterator[Tuple[int, str, int, Any, float]]:
+        for (index, file), (exit_code, output, seconds) in zip(arg_batch_items, arg_batch_results):
+            yield index, file, exit_code, output, seconds
+
+    if arg_pool is None:
+        for batch in l_batches:
+            yield from _results(batch, arg_run([file for _, file in batch]))
+        return
+
+    l_window = arg_jobs * 4 # Max number of batches that are started but not yet yielded. Makes sure we never read the whole arg_files into memory
+    l_running: Dict[concurrent.futures.Future, List[Tuple[int, str]]] = {}
+    l_finished: Dict[int, Tuple[int, str, int, Any, float]] = {} # Only used with arg_keep_order, waiting for an earlier file to finish
+    l_next_index = 1
+    while True:
+        while len(l_running) + len(l_finished) // max(1, arg_batch) < l_window:
+            batch = next(l_batches, None)
+            if batch is None:
+                break
+            l_running[arg_pool.submit(arg_run, [file for _, file in batch])] = batch
+        if not l_running:
+            break
+
+        done, _ = concurrent.futures.wait(l_running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            batch = l_running.pop(future)
+            for result in _results(batch, future.result()):
+                if arg_keep_order:
+                    l_finished[result[0]] = result
+                else:
+                    yield result
+
+        while l_next_index in l_finished:
+            yield l_finished.pop(l_next_index)
+            l_next_index += 1
+
+def exec_many(arg_command: Union[str, List[str]], arg_files: Iterable[str], arg_jobs: int = 1, arg_keep_order: bool = False, arg_capture_output: bool = False, arg_batch: int = 1) -> Iterator[Tuple[int, str, int, bytes, float]]:
+    ''' Run the command on all the files with at most arg_jobs commands running at the same time.
+        Yields (index, file, exit code, output, seconds) when a command is done. The index starts at 1.
+        If arg_keep_order is True the results are yielded in the same order as arg_files, otherwise as soon as they are done.
+        arg_batch > 1 gives each command up to that many files (arg_command must be an argv template). All the files in a batch get the same exit code,
+        the output is given with the first file and the seconds are split evenly. A batch that is too long for one command line is split in two
+    '''
+    def _run(arg_batch_files: List[str]) -> List[Tuple[int, Any, float]]:
+        try:
+            exit_code, output, seconds = exec_command(arg_command, arg_batch_files[0] if isinstance(arg_command, str) else arg_batch_files, arg_capture_output)
+        except OSError as err:
+            if errno.E2BIG != err.errno:
+                raise
+            l_half = len(arg_batch_files) // 2
+            return _run(arg_batch_files[:l_half]) + _run(arg_batch_files[l_half:])
+        return [(exit_code, output if 0 == i else b"", seconds / len(arg_batch_files)) for i in range(len(arg_batch_files))]
+
+    if arg_jobs <= 1: # No need for threads
+        yield from _run_many(_run, arg_files, None, 1, arg_batch, arg_keep_order)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=arg_jobs) as pool: # Threads are enough, the real work is done in the subprocesses
+        yield from _run_many(_run, arg_files, pool, arg_jobs, arg_batch, arg_keep_order)
+
+_g_worker_function: Union[Callable[[str], Any], None] = None # The function call_many() calls in this process, set by _worker_init()
+
+def load_function(arg_function_spec: str) -> Callable[[str], Any]:
+    ''' Imports "module:function" and returns the function. The module can also be the path to a .py file, for example "template.py:file_work".
+        Raises ImportError with arg_function_spec in the message if the module cannot be imported or has no such function
+    '''
+    import importlib # Imported here since it's only needed here
+    import importlib.util
 
-    command = command.replace("%file", arg_file)
-    os.system(command)
+    l_module_name, _, l_function_name = arg_function_spec.rpartition(":") # rpartition() since a Windows path has a : in it
+    if not l_module_name or not l_function_name:
+        raise ImportError(f'"{arg_function_spec}" must be module:function')
+    try:
+        if l_module_name.endswith(".py") or os.path.isfile(l_module_name):
+            l_spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(l_module_name))[0], l_module_name)
+            if l_spec is None or l_spec.loader is None:
+                raise ImportError(f'Cannot import "{l_module_name}"')
+            l_module = importlib.util.module_from_spec(l_spec)
+            sys.modules[l_spec.name] = l_module # Same as import does. @typechecked, dataclasses and pickle look the module up here
+            try:
+                l_spec.loader.exec_module(l_module)
+            except BaseException:
+                sys.modules.pop(l_spec.name, None)
+                raise
+        else:
+            if os.getcwd() not in sys.path:
+                sys.path.insert(0, os.getcwd()) # Same as python -m, the modules in the current folder can be used
+            l_module = importlib.import_module(l_module_name)
+    except Exception as err: # pylint: disable=broad-except
+        raise ImportError(f'Cannot load "{arg_function_spec}": {type(err).__name__}: {err}') from err
+    res = getattr(l_module, l_function_name, None)
+    if not callable(res):
+        raise ImportError(f'Cannot load "{arg_function_spec}": "{l_module_name}" has no function named "{l_function_name}"')
+    return res
+
+def _worker_init(arg_function_spec: str) -> None:
+    ''' Internal function. Runs once in each worker process, the module is imported here and not for every file '''
+    global _g_worker_function # pylint: disable=global-statement
+    _g_worker_function = load_function(arg_function_spec)
+
+def _call_chunk(arg_files: List[str]) -> List[Tuple[int, Union[str, None], float]]:
+    ''' Internal function. Calls the function for each file. Returns (0, str(return value), seconds) or (1, the traceback, seconds) for each file.
+        The return value is made a str here since it is printed anyway and not everything can be pickled back to the parent process
+    '''
+    import traceback # Imported here since it's only needed when something fails
+
+    res: List[Tuple[int, Union[str, None], float]] = []
+    for file in arg_files:
+        started = time.monotonic()
+        try:
+            l_value = _g_worker_function(file) # type: ignore
+            res.append((0, None if l_value is None else str(l_value), time.monotonic() - started))
+        except Exception: # pylint: disable=broad-except
+            res.append((1, traceback.format_exc(), time.monotonic() - started))
+    return res
+
+def call_many(arg_function_spec: str, arg_files: Iterable[str], arg_jobs: int = 1, arg_keep_order: bool = False, arg_chunk_size: int = 16) -> Iterator[Tuple[int, str, int, Any, float]]:
+    ''' Calls the Python function arg_function_spec ("module:function", see load_function()) with each file, instead of starting a program for each file.
+        The module is imported once in each of the arg_jobs worker processes and the files are sent to them arg_chunk_size at a time.
+        Yields (index, file, exit code, str(return value) or None, seconds). The exit code is 1 and the traceback is given instead if the function raised an exception.
+        Raises ImportError (with arg_function_spec in the message) if the function cannot be loaded
+    '''
+    _worker_init(arg_function_spec) # Also with many jobs, so an import error is reported here with its name instead of as a broken process pool
+    if arg_jobs <= 1: # Everything in this process
+        yield from _run_many(_call_chunk, arg_files, None, 1, 1, arg_keep_order)
+        return
+    import concurrent.futures.process # Imported here since it's only needed here
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=arg_jobs, initializer=_worker_init, initargs=(arg_function_spec,)) as pool:
+        try:
+            yield from _run_many(_call_chunk, arg_files, pool, arg_jobs, arg_chunk_size, arg_keep_order)
+        except concurrent.futures.process.BrokenProcessPool as err:
+            raise ImportError(f'The worker processes stopped, they could not load or run "{arg_function_spec}": {err}') from err
 
 if __name__ == '__main__':
-    import sys
     import argparse
 
     parser = argparse.ArgumentParser(description=f"python {sys.argv[0]} \"string to be os.system() by Python\" file_1 [file_2 ... file_n] Example: python {sys.argv[0]} \"echo I will work on the file: \\\"%file\\\"\" *.py")
     parser.add_argument("-s", "--subfolders", action="store_true", dest="check_subfolders", help="Look in subfolders. Default: False", default=False)
     parser.add_argument("-f", "--file", action="store_true", dest="file_list", help="The file given contains filenames to work on. Default: False", default=False)
-    parser.add_argument("-p", "--progress", dest="progress_file", help="Write current progress to this file before every file. This will cause many disk writes.", default=None)
+    parser.add_argument("-p", "--progress", dest="progress_file", help="Write the current progress to this file, at most every --progress-interval seconds. Default: None", default=None)
+    parser.add_argument("--progress-interval", type=float, dest="progress_interval", help="Seconds between the writes of the --progress file. Default: 1.0", default=1.0)
+    parser.add_argument("-j", "--jobs", type=int, dest="jobs", help="Number of commands to run at the same time, 0 means one per CPU. Default: 1", default=1)
+    parser.add_argument("-k", "--keep-order", action="store_true", dest="keep_order", help="When using --jobs, print the output of the commands in the same order as the files. Default: False", default=False)
+    parser.add_argument("-u", "--unsorted", action="store_true", dest="unsorted", help="Start working on the files as soon as they are found instead of sorting them first. Default: False", default=False)
+    parser.add_argument("-c", "--cache", dest="cache_file", help="Save the folder listings in this SQLite file and only list folders that have changed since the last run. Default: None", default=None)
+    parser.add_argument("-o", "--offset", type=int, dest="offset", help="Start at this byte offset in the file list (--file or -), to resume an interrupted run. --progress shows the offset to resume from. Default: 0", default=0)
+    parser.add_argument("-J", "--journal", dest="journal_file", help="Save the exit code and time of every command in this SQLite file. Default: None", default=None)
+    parser.add_argument("-r", "--resume", action="store_true", dest="resume", help="Skip the files where the same command already has exit code 0 in the --journal. Default: False", default=False)
+    parser.add_argument("-a", "--argv", action="store_true", dest="argv", help="Split the command into arguments and run it directly without a shell. %%file is always one argument, quotes and $ in filenames are safe. Default: False", default=False)
+    parser.add_argument("-n", "--batch", type=int, dest="batch", help="With --argv, give each command up to this many files (like xargs -n). A %%file argument becomes one argument per file, without %%file the files are added last. Default: 1", default=1)
+    parser.add_argument("-m", "--module", action="store_true", dest="module", help="The command is module:function (or file.py:function), it is imported once in each worker process and called with each file. What it returns is printed. Default: False", default=False)
+    parser.add_argument("--chunk-size", type=int, dest="chunk_size", help="With --module, how many files are sent to a worker process at a time. Default: 16", default=16)
     parser.add_argument("-b", "--basename", action="store_true", dest="only_basename", help="Use only the basename of the file. Default: False", default=False)
     parser.add_argument("command", help="The OS command to run. Use the string %%file for the filename replacement")
     parser.add_argument("file", nargs="+", help="The file(s) to work on. Use - for stdin")
     args = parser.parse_args()
+    list_mode = args.file_list or "-" == args.file[0]
+    if args.offset and not (list_mode and 1 == len(args.file)):
+        parser.error("--offset needs exactly one file list (--file or -)")
+    if args.resume and not args.journal_file:
+        parser.error("--resume needs --journal")
+    if args.batch > 1 and not args.argv:
+        parser.error("--batch needs --argv")
+    if args.module and args.argv:
+        parser.error("--module and --argv cannot be used together")
+    command = args.command.strip()
+    argv_template = split_command(command) if args.argv else None
+    if argv_template is not None and args.batch > 1 and any("%file" in arg and "%file" != arg for arg in argv_template):
+        parser.error("--batch needs %file as its own argument")
+    journal = journal_open(args.journal_file) if args.journal_file else None
+    skip = journal_done_files(journal, command) if journal and args.resume else None
+    if skip:
+        hu.log_print(f"Resuming, {len(skip)} files are already done", arg_type="INFO", arg_file=sys.stderr)
 
-    files = []
+    files: Iterable[str] = []
     if "-" == args.file[0]:
-        files.append("-")
-    else:
-        files = hu.adv_glob(args.file, args.check_subfolders)
+        files = ["-"]
+    elif args.unsorted:
+        files = hu.iter_glob(args.file, args.check_subfolders, arg_cache_file=args.cache_file) # Start on the first file as soon as it is found
+    elif args.file_list:
+        files = hu.adv_glob(args.file, args.check_subfolders, arg_cache_file=args.cache_file)
+    else: # file2 before file10. Each chunk is sorted while the next folders are listed
+        files = hu.natural_sorted(hu.iter_glob(args.file, args.check_subfolders, arg_cache_file=args.cache_file), arg_chunk_size=65536)
 
-    start_time = time.time()
+    line_offsets: Union[collections.deque, None] = collections.deque() if list_mode and 1 == len(args.file) else None # Offsets of the lines that are started but not yet done
+    work: Iterable[str] = files_to_work_on(files, args.file_list, args.only_basename, args.offset, line_offsets, skip)
+    total = 0 # 0 means that we don't know how many files there are
+    if not args.unsorted and not list_mode: # A file list is read while the commands run, it can be very big
+        work = list(work)
+        total = len(work)
 
-    if use_natsort and not args.file_list:
-        files = natsort.natsorted(files)
-    index = 0
-    for file in files:
-        index += 1
-        if args.only_basename:
-            file = os.path.basename(file)
-        if args.file_list or "-" == file:
-            if "-" == file: # stdin
-                lines = sys.stdin.readlines()
-            else:
-                with open(file, 'r', encoding='utf8', newline='\n') as f:
-                    lines = f.readlines()
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                do_exec(args.command.strip(), line, index, len(files), start_time, args.progress_file)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    capture_output = args.keep_order and jobs > 1 # Output from commands running at the same time would be mixed, so keep it until it is this file's turn
+    failed = []
+    done = 0
+    file = ""
+    progress = ProgressReporter(args.progress_file, total, args.progress_interval) if args.progress_file else None
+    first_not_done = 1 # The index of line_offsets[0]
+    done_out_of_order = set() # Indexes that are done but an earlier one is not
+    resume_offset = -1
+    try:
+        if args.module:
+            results = call_many(command, work, jobs, args.keep_order, args.chunk_size)
         else:
-            do_exec(args.command.strip(), file, index, len(files), start_time, args.progress_file)
+            results = exec_many(argv_template if argv_template is not None else command, work, jobs, args.keep_order, capture_output, args.batch)
+        for done, (index, file, exit_code, output, seconds) in enumerate(results, 1):
+            if args.module and output is not None: # What the function returned, or the traceback
+                output = f"{output}\n".encode("utf-8", errors="backslashreplace")
+            if output:
+                sys.stdout.flush()
+                sys.stdout.buffer.write(output)
+                sys.stdout.buffer.flush()
+            if 0 != exit_code:
+                failed.append((file, exit_code))
+            if journal:
+                journal_add(journal, command, file, exit_code, seconds)
+            resume_offset = -1
+            if line_offsets is not None:
+                done_out_of_order.add(index)
+                while first_not_done in done_out_of_order:
+                    done_out_of_order.remove(first_not_done)
+                    line_offsets.popleft()
+                    first_not_done += 1
+                resume_offset = line_offsets[0] if line_offsets else -1
+            if progress:
+                progress.update(done, len(failed), file, resume_offset)
+    except ImportError as err: # --module could not load the function
+        hu.error_print(str(err))
+        sys.exit(2)
+    finally: # Also on Ctrl+C, so everything that is done is saved
+        if progress:
+            progress.write(done, len(failed), file, resume_offset)
+        if journal:
+            journal_close(journal)
+
+    for file, exit_code in failed:
+        hu.warning_print(f"Exit code {exit_code} for \"{file}\"")
+    if failed:
+        hu.error_print(f"{len(failed)} of {done} commands failed")
+        sys.exit(1)
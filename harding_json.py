@@ -19,50 +19,138 @@ json_source = "json_source"
 json_date = "json_date"
 json_data = "json_data"
 
+import os
+import json
 import harding_utils as hu
 
 def unwrapped_json(arg_file: str) -> dict:
     ''' If our JSON is wrapped with our metadata, then return the original dict '''
 
     _wrapped = wrapped_json(arg_file)
-    return _wrapped.get('json_data', None)
+    return _wrapped.get('json_data', None) if _wrapped is not None else None
 
-def wrapped_json(arg_file: str, arg_save_as: str = None) -> dict:
+def iter_unwrapped_json(arg_file: str):
+    ''' Same as unwrapped_json() but reads the file a chunk at a time and yields one item at a time.
+        Yields the items if json_data is a list or (key, value) if it is a dict. Works on both wrapped and raw JSON files
+    '''
+
+    if arg_file.startswith("http"):
+        l_data = unwrapped_json(arg_file)
+        yield from (l_data.items() if isinstance(l_data, dict) else l_data)
+        return
+
+    first = next(hu.json_iter_file(arg_file), None) # Only the first key is parsed to see if the file is wrapped
+    if isinstance(first, tuple) and first[0] in (json_source, json_date, json_data):
+        yield from hu.json_iter_file(arg_file, [json_data])
+    else:
+        yield from hu.json_iter_file(arg_file)
+
+def save_as_filename(arg_url: str) -> str:
+    ''' The local filename that a downloaded JSON is saved as '''
+    _t = hu.smart_filesystem_safe_path(arg_url)
+    _t += ".json"
+    return _t.replace(".json.json", ".json")
+
+def wrapped_json(arg_file: str, arg_save_as: str = None, arg_downloaded_file: str = None) -> dict:
+    ''' arg_downloaded_file is used if the URL in arg_file has already been downloaded (by module_work()). Returns None if the download failed '''
     updated_at = ""
+    _tmp_download = None
     if isinstance(arg_file, dict):
         json_content = arg_file
     else:
         if arg_file.startswith("http"):
-            if not arg_save_as:
-                _t = hu.smart_filesystem_safe_path(arg_file)
-                _t += ".json"
-                _t = _t.replace(".json.json", ".json")
+            if arg_downloaded_file:
+                _t = arg_downloaded_file
+            elif arg_save_as and hu.file_compression(arg_save_as, arg_check_content=False):
+                _t = _tmp_download = hu.download_file(arg_url=arg_file, arg_use_cache=True) # A compressed snapshot is written below, with the metadata
             else:
-                _t = arg_save_as
-
-            _t = hu.download_file(arg_url=arg_file, arg_local_filename=_t)
+                _t = arg_save_as if arg_save_as else save_as_filename(arg_file)
+                _t = hu.download_file(arg_url=arg_file, arg_local_filename=_t, arg_use_cache=True)
             updated_at = hu.now_nice_format()
+            if hu.DOWNLOAD_FAILED == _t:
+                hu.error_print(f"Could not download \"{arg_file}\"" + (f", \"{arg_save_as}\" is not updated" if arg_save_as else ""))
+                return None
         else:
             _t = arg_file
 
-        json_content = hu.dict_load_json_file(_t)
+        json_content = hu.dict_load_json_file(_t) # .json.gz, .json.xz and .json.zst are decompressed
+        if json_content is None:
+            if _tmp_download:
+                hu.file_delete(_tmp_download)
+            hu.error_print(f"\"{arg_file}\" did not give any JSON" + (f", \"{arg_save_as}\" is not updated" if arg_save_as else "")) # The old snapshot is kept
+            return None
 
     # Here we have the JSON data in our dict
     if json_data not in json_content:
         updated_at = hu.now_nice_format()
         json_content = {json_source: arg_file, json_date: updated_at, json_data: json_content}
 
+    if _tmp_download:
+        hu.file_delete(_tmp_download)
+        hu.dict_dump_to_json_file(json_content, arg_save_as) # Compressed while it is written, never as plain text on disk
+
     return json_content
 
-def file_work(arg_file: str, arg_update_json: bool = False):
-    """ This is all the work done on each file """
+def history_filename(arg_file: str) -> str:
+    ''' The file next to the snapshot where update_with_history() saves the changes. snap.json.gz --> snap.json.history.jsonl.gz '''
+    _base, _ext = os.path.splitext(arg_file)
+    if hu.file_compression(arg_file, arg_check_content=False):
+        return f"{_base}.history.jsonl{_ext}"
+    return f"{arg_file}.history.jsonl"
+
+def update_with_history(arg_file: str, arg_json_content: dict):
+    ''' Downloads json_source of the snapshot arg_file again. Only what has changed is appended to history_filename(arg_file),
+        one JSON line per update made by hu.dict_compare_deep(). The old json_data can be recreated with hu.dict_apply_changes(..., arg_reverse=True)
+        Returns (new wrapped JSON, changes) or (None, None) if the download failed
+    '''
+    _t = hu.download_file(arg_url=arg_json_content[json_source], arg_use_cache=True)
+    new_data = hu.dict_load_json_file(_t) if hu.DOWNLOAD_FAILED != _t else None
+    hu.file_delete(_t)
+    if new_data is None:
+        hu.error_print(f"Could not download \"{arg_json_content[json_source]}\", \"{arg_file}\" is not updated")
+        return None, None
+
+    changes = hu.dict_compare_deep(arg_json_content[json_data], new_data)
+    if not changes:
+        return arg_json_content, changes # Nothing to write, json_date is when it last changed
+
+    new_content = {json_source: arg_json_content[json_source], json_date: hu.now_nice_format(), json_data: new_data}
+    with hu.file_open(history_filename(arg_file), "a") as f: # Append only, a compressed history gets one more compressed part
+        f.write(json.dumps({json_date: new_content[json_date], "previous_date": arg_json_content.get(json_date, ""), "changes": changes}, ensure_ascii=False, default=str) + "\n")
+    hu.dict_dump_to_json_file(new_content, arg_file)
+    return new_content, changes
+
+def print_changes(arg_changes: list):
+    ''' One line per change: + added, - removed, ~ modified '''
+    for change in arg_changes:
+        _path = ".".join(str(p) for p in change["path"])
+        if "added" == change["op"]:
+            print(f"+ {_path}: {json.dumps(change['new'], ensure_ascii=False, default=str)}")
+        elif "removed" == change["op"]:
+            print(f"- {_path}: {json.dumps(change['old'], ensure_ascii=False, default=str)}")
+        else:
+            print(f"~ {_path}: {json.dumps(change['old'], ensure_ascii=False, default=str)} --> {json.dumps(change['new'], ensure_ascii=False, default=str)}")
 
-    json_content = wrapped_json(arg_file)
+def file_work(arg_file: str, arg_update_json: bool = False, arg_downloaded_file: str = None, arg_diff: bool = False):
+    """ This is all the work done on each file. arg_diff together with arg_update_json only prints what has changed and saves it in history_filename() """
+
+    json_content = wrapped_json(arg_file, arg_downloaded_file=arg_downloaded_file)
+    if json_content is None:
+        return None
     if arg_update_json and not arg_file.startswith('http'):
         if json_source not in json_content:
             hu.error_print(f"No field named \"{json_source}\" in the JSON, cannot update!")
             return None
+        if arg_diff:
+            json_content, changes = update_with_history(arg_file, json_content)
+            if json_content is None:
+                return None
+            print_changes(changes)
+            print(f"{len(changes)} changes in \"{arg_file}\"" if changes else f"No changes in \"{arg_file}\" since {json_content[json_date]}")
+            return json_content[json_data]
         json_content = wrapped_json(json_content[json_source], arg_save_as = arg_file)
+        if json_content is None:
+            return None
 
     print(hu.dict_to_json_string_pretty(json_content[json_data]))
     if json_source in json_content:
@@ -72,10 +160,21 @@ def file_work(arg_file: str, arg_update_json: bool = False):
 
     return json_content[json_data]
 
-def module_work(arg_files: list, arg_update_json: bool = False) -> int:
+def module_work(arg_files: list, arg_update_json: bool = False, arg_diff: bool = False) -> int:
     ''' This is all the work the module is doing '''
+    urls = [file for file in arg_files if file.startswith('http')]
+    if len(urls) < 2:
+        urls = []
+    url_set = set(urls)
     for file in arg_files:
-        file_work(file, arg_update_json)
+        if file not in url_set:
+            file_work(file, arg_update_json, arg_diff=arg_diff)
+
+    # Many URLs are downloaded at the same time and handled as soon as each one is done
+    for url, downloaded_file in hu.download_many(urls, arg_local_filenames={url: save_as_filename(url) for url in urls}, arg_use_cache=True):
+        if hu.DOWNLOAD_FAILED == downloaded_file:
+            continue
+        file_work(url, arg_update_json, arg_downloaded_file=downloaded_file)
     return 0
 
 def module_main(arg_argv: dict = None) -> int:
@@ -99,7 +198,7 @@ def module_main(arg_argv: dict = None) -> int:
         hu.error_print("files[] is empty!")
         return -1
 
-    return module_work(files, arg_argv.get('update_json', False))
+    return module_work(files, arg_argv.get('update_json', False), arg_argv.get('diff', False))
 
 if __name__ == "__main__":
     import argparse
@@ -111,6 +210,8 @@ if __name__ == "__main__":
                         dest="check_subfolders", help="Look in subfolders", default=False)
     parser.add_argument("-u", "--update", action="store_true",
                         dest="update_json", help="Update the JSON file", default=False)
+    parser.add_argument("-d", "--diff", action="store_true",
+                        dest="diff", help="With --update: only print what has changed and append it to FILE.history.jsonl", default=False)
     parser.add_argument("file", nargs="+")
     args = parser.parse_args()
 
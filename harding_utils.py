@@ -25,42 +25,128 @@ import inspect as _inspect
 import pathlib
 import json
 import glob
+import fnmatch
 import re
 import decimal
 import random
-from typing import Union, Dict, List, Tuple, Set, TypeVar, Any
+import array
+import collections
+import itertools
+import heapq
+import unicodedata
+import functools
+import linecache
+import threading
+import concurrent.futures
+import ssl
+import http.client
+import urllib.parse
+import html
+import html.parser
+from typing import Union, Dict, List, Tuple, Set, TypeVar, Any, Iterator, Iterable, Callable
 from types import ModuleType
-STRICT_TYPES = True # If you want to have stict type checking: pip install typeguard
+TYPECHECK_MODE = os.environ.get("HARDING_UTILS_TYPECHECK", "").strip().lower() or "full" # full: check every call, public: only check calls from other modules to functions not starting with _, none: no checks at all
+if TYPECHECK_MODE not in ("full", "public", "none"): # warning_print() is not defined yet
+    sys.stderr.write(f'WARNING: HARDING_UTILS_TYPECHECK="{os.environ.get("HARDING_UTILS_TYPECHECK")}" is not one of full, public or none, using full\n')
+    TYPECHECK_MODE = "full"
+STRICT_TYPES = "none" != TYPECHECK_MODE # If you want to have stict type checking: pip install typeguard
 try:
     if not STRICT_TYPES:
         raise ImportError("Skipping the import of typeguard reason: STRICT_TYPES == False")
-    from typeguard import typechecked
+    from typeguard import typechecked as _typeguard_typechecked
 except:
     STRICT_TYPES = False
+    TYPECHECK_MODE = "none"
     _T = TypeVar("_T")
 
     def typechecked(target: _T, **kwargs) -> _T: # type: ignore
         return target if target else typechecked # type: ignore
-
-use_natsort = True
-try: # It will function without this sorting
-    import natsort
+else:
+    def typechecked(target = None, **kwargs): # type: ignore
+        ''' typeguard.typechecked that follows TYPECHECK_MODE. Other modules can use this one to get the same behaviour.
+            In "public" mode, functions starting with _ are not checked and calls between functions in the same module are not checked again
+        '''
+        if target is None:
+            return functools.partial(typechecked, **kwargs)
+        if "public" != TYPECHECK_MODE:
+            return _typeguard_typechecked(target, **kwargs)
+        if isinstance(target, type) or target.__name__.startswith('_'):
+            return target
+        l_checked = _typeguard_typechecked(target, **kwargs)
+        l_module_globals = target.__globals__
+
+        @functools.wraps(target)
+        def _public_entry_point(*args, **kwargs_to_target):
+            if sys._getframe(1).f_globals is l_module_globals: # pylint: disable=protected-access # The caller is in the same module and has already been checked
+                return target(*args, **kwargs_to_target)
+            return l_checked(*args, **kwargs_to_target)
+        _g_typecheck_wrapper_codes.add(_public_entry_point.__code__)
+        return _public_entry_point
+
+_g_typecheck_wrapper_codes: Set[Any] = set() # The frames of these are skipped by _caller_frame()
+
+def _caller_frame(arg_num_function_away: int = 1) -> Any:
+    ''' Internal function. Same as sys._getframe() but the frames added by typechecked() in "public" mode are not counted.
+        0 represents the function that called _caller_frame(), 1 the function that called that function and so on
+    '''
+    frame = sys._getframe(1) # pylint: disable=protected-access
+    if not _g_typecheck_wrapper_codes:
+        for _ in range(arg_num_function_away):
+            frame = frame.f_back
+        return frame
+    while arg_num_function_away:
+        frame = frame.f_back
+        if frame.f_code not in _g_typecheck_wrapper_codes:
+            arg_num_function_away -= 1
+    return frame
+
+JSON_BACKEND = "json" # The fastest JSON lib that is installed, used by dict_dump_to_json_file(arg_compact=True)
+try: # These are not required, they only make compact JSON files faster to write
+    import orjson
+    JSON_BACKEND = "orjson"
 except ImportError:
-    use_natsort = False
-    print("WARNING: Module natsort not installed, this module is not required but strongly recommended. pip install natsort")
+    try:
+        import ujson
+        JSON_BACKEND = "ujson"
+    except ImportError:
+        pass
 
 __user_agent__: str = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
 
 @typechecked
-def adv_glob(arg_paths: Union[List[str], str], arg_recursive: bool = False, arg_supress_errors: bool = False, arg_debug: bool = False) -> List[str]:
+def adv_glob(arg_paths: Union[List[str], str], arg_recursive: bool = False, arg_supress_errors: bool = False, arg_debug: bool = False, arg_cache_file: Union[str, None] = None) -> List[str]:
     ''' Returns a list of files (with full path) that matches a list of filters.
         Example arg_paths: c:\\a.txt c:\\a\\folder1 folder* folder1 folder2\\ folder1\\* fodler5 non-existant_file.txt folder2 *.log
 
         # TODO: Rewrite this function with https://docs.python.org/3/library/pathlib.html#pathlib.Path
         # TODO: If I give "file1.mp4 *.mp4" This should expand the *.mp4 (which include file1.mp4) but only handle that file once.
         # This is for doing something on many files but prio the first one
+
+        arg_cache_file is an optional SQLite file where the folder listings are saved. See dir_cache_stats()
+    '''
+
+    file_filters, _list_of_urls = _adv_glob_filters(arg_paths, arg_supress_errors, arg_debug)
+
+    # Filters done, now create a file list
+    return_list = list(_iter_glob_files(file_filters, arg_recursive, arg_supress_errors, arg_debug, arg_cache_file))
+    return_list.sort()
+    return_list.extend(_list_of_urls)
+    return return_list
+
+@typechecked
+def iter_glob(arg_paths: Union[List[str], str], arg_recursive: bool = False, arg_supress_errors: bool = False, arg_debug: bool = False, arg_cache_file: Union[str, None] = None) -> Iterator[str]:
+    ''' Same as adv_glob() but yields the files as soon as they are found instead of returning a sorted list.
+        Every file is only yielded once. URLs are yielded last.
     '''
 
+    file_filters, _list_of_urls = _adv_glob_filters(arg_paths, arg_supress_errors, arg_debug)
+    yield from _iter_glob_files(file_filters, arg_recursive, arg_supress_errors, arg_debug, arg_cache_file)
+    yield from _list_of_urls
+
+@typechecked
+def _adv_glob_filters(arg_paths: Union[List[str], str], arg_supress_errors: bool = False, arg_debug: bool = False) -> Tuple[Dict[str, Set[str]], List[str]]:
+    ''' Internal function. Splits the paths given to adv_glob() into {folder: filters} and a list of URLs '''
+
     _list_of_urls = []
     file_filters: Dict[str, Set] = {}
     arg_paths_list: list
@@ -75,15 +161,15 @@ def adv_glob(arg_paths: Union[List[str], str], arg_recursive: bool = False, arg_
     for i in arg_paths_list:
         # file_filters becomes "*.*" if you give them without any filter
         if i.startswith('http'):
-            debug("URL: " + str(i), not arg_debug)
+            debug_lazy("URL: %s", i, arg_supress_output=not arg_debug)
             _list_of_urls.append(i)
         elif os.path.isdir(i):
-            debug("Folder: " + str(i), not arg_debug)
+            debug_lazy("Folder: %s", i, arg_supress_output=not arg_debug)
             if not os.path.abspath(i) in file_filters:
                 file_filters[os.path.abspath(i)] = set()
             file_filters[os.path.abspath(i)].add("*")
         elif os.path.dirname(os.path.abspath(i)) and os.path.basename(os.path.abspath(i)):
-            debug(f"Split to k = '{os.path.dirname(os.path.abspath(i))}'   v = '{os.path.basename(os.path.abspath(i))}'", not arg_debug)
+            debug_lazy("Split to k = '%s'   v = '%s'", os.path.dirname(os.path.abspath(i)), os.path.basename(os.path.abspath(i)), arg_supress_output=not arg_debug)
             if not os.path.dirname(os.path.abspath(i)) in file_filters:
                 file_filters[os.path.dirname(os.path.abspath(i))] = set()
             file_filters[os.path.dirname(os.path.abspath(i))].add(os.path.basename(os.path.abspath(i)))
@@ -92,7 +178,7 @@ def adv_glob(arg_paths: Union[List[str], str], arg_recursive: bool = False, arg_
     file_filters_2 = {}
     for k, v in file_filters.items():
         if os.path.isdir(k):
-            debug(f"k: {k}, v: {v}", not arg_debug)
+            debug_lazy("k: %s, v: %s", k, v, arg_supress_output=not arg_debug)
             file_filters_2[k] = v
         elif k.startswith('http'):
             continue
@@ -100,53 +186,255 @@ def adv_glob(arg_paths: Union[List[str], str], arg_recursive: bool = False, arg_
             warning_print("Could not find folder \"" + k + "\"")
     file_filters = file_filters_2
 
-    debug("File filters = " + str(file_filters), not arg_debug)
+    debug_lazy("File filters = %s", file_filters, arg_supress_output=not arg_debug)
+    return file_filters, _list_of_urls
 
-    # Filters done, now create a file list
-    return_list = []
-    for k, v in file_filters.items():
-        return_list.extend(list_of_files(k, v, arg_recursive, arg_supress_errors, arg_debug))
+@typechecked
+def _iter_glob_files(arg_file_filters: Dict[str, Set[str]], arg_recursive: bool = False, arg_supress_errors: bool = False, arg_debug: bool = False, arg_cache_file: Union[str, None] = None) -> Iterator[str]:
+    ''' Internal function. Walks every folder in arg_file_filters once and yields the matching files.
 
-    return_list = list(set(return_list))
-    return_list.sort()
-    return_list.extend(_list_of_urls)
-    return return_list
+        When recursive, a folder that is inside another folder in arg_file_filters is not walked again. Its filters are
+        added to the filters of the outer folder when the walk gets there. That way no file is yielded twice
+        and the only thing we need to remember is arg_file_filters itself.
+    '''
+    l_roots: List[str] = []
+    for k in sorted(arg_file_filters): # A parent folder is always sorted before its subfolders
+        if arg_recursive and any(k.startswith(os.path.join(root, '')) for root in l_roots):
+            continue
+        l_roots.append(k)
+
+    for root in l_roots:
+        yield from iter_files(root, arg_file_filters[root], arg_recursive, arg_supress_errors, arg_debug, arg_file_filters if arg_recursive else None, arg_cache_file)
 
 @typechecked
 def list_of_files(arg_folder: str,
                   arg_filters: Union[None, str, List, Set, Tuple] = "*",
                   arg_recursive: bool = False,
                   arg_supress_errors: bool = False,
-                  arg_debug: bool = False) -> List[str]:
+                  arg_debug: bool = False,
+                  arg_cache_file: Union[str, None] = None) -> List[str]:
     """ Helper funtion to adv_glob """
-    res: List[str] = []
+    return list(iter_files(arg_folder, arg_filters, arg_recursive, arg_supress_errors, arg_debug, None, arg_cache_file))
+
+@typechecked
+def iter_files(arg_folder: str,
+               arg_filters: Union[None, str, List, Set, Tuple] = "*",
+               arg_recursive: bool = False,
+               arg_supress_errors: bool = False,
+               arg_debug: bool = False,
+               arg_extra_filters: Union[Dict[str, Set[str]], None] = None,
+               arg_cache_file: Union[str, None] = None) -> Iterator[str]:
+    """ Yields all files in arg_folder that matches any of the filters. Every folder is only listed once (with os.scandir)
+        and all filters are compiled into one regexp that is checked on each entry in that listing. OBS! No folders whatsoever
+
+        arg_extra_filters is {folder: filters} with filters that are added for that folder and its subfolders when recursive
+        arg_cache_file is an optional SQLite file with folder listings. Only folders where the mtime has changed are listed again.
+    """
     filters = list_from_str(arg_filters)
     if not filters:
-        return res
-    debug("list_of_files() arg_folder = " + arg_folder + ", argfilters = " + str(filters) + "", not arg_debug)
-    # Add all files matching the filter. OBS! No folders whatsoever
-    for i in filters:
-        full_path = os.path.join(arg_folder, i).replace('[', '?').replace(']', '?')
-        debug(full_path, not arg_debug)
-        the_glob_list = glob.glob(full_path)
-
-        debug("list_of_files() Globbing " + os.path.join(arg_folder, i) + " = " + str(the_glob_list), not arg_debug)
-        for j in the_glob_list:
-            if os.path.isfile(j):
-                res.append(j)
-
-    # If we should be recursive then do this for all folders
-    if arg_recursive:
-        sub_folders = []
+        return
+    l_cache = _dir_cache_open(arg_cache_file) if arg_cache_file else None
+    try:
+        yield from _iter_files_walk(arg_folder, tuple(dict.fromkeys(filters)), arg_recursive, arg_supress_errors, arg_debug, arg_extra_filters, l_cache)
+    finally:
+        if l_cache:
+            _dir_cache_close(l_cache, arg_debug)
+
+@typechecked
+def _iter_files_walk(arg_folder: str,
+                     arg_filters: Tuple[str, ...],
+                     arg_recursive: bool,
+                     arg_supress_errors: bool,
+                     arg_debug: bool,
+                     arg_extra_filters: Union[Dict[str, Set[str]], None],
+                     arg_cache: Union[Dict[str, Any], None]) -> Iterator[str]:
+    """ Internal function. The walk done by iter_files() """
+    l_stack: List[Tuple[str, Tuple[str, ...]]] = [(arg_folder, arg_filters)]
+    while l_stack:
+        folder, folder_filters = l_stack.pop()
+        debug_lazy("iter_files() folder = %s, filters = %s", folder, folder_filters, arg_supress_output=not arg_debug)
+        visible_regexp, hidden_regexp, path_filters = _compile_filters(folder_filters)
+        sub_folders: List[str] = []
         try:
-            sub_folders = os.listdir(arg_folder)
-        except:
-            warning_print("Could not open \"" + arg_folder + "\" for file listing")
-        for i in sub_folders:
-            if os.path.isdir(os.path.join(arg_folder, i)):
-                res.extend(list_of_files(os.path.join(arg_folder, i), arg_filters, arg_recursive, arg_supress_errors, arg_debug))
+            if arg_cache is not None:
+                file_names, dir_names = _dir_cache_listing(arg_cache, folder)
+                for file_name in file_names:
+                    name = os.path.normcase(file_name)
+                    l_regexp = hidden_regexp if name.startswith('.') else visible_regexp
+                    if l_regexp and l_regexp.match(name):
+                        yield os.path.join(folder, file_name)
+                if arg_recursive:
+                    sub_folders = [os.path.join(folder, d) for d in dir_names]
+            else:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.is_file(): # DirEntry caches this so there is no extra stat() like with os.path.isfile()
+                            name = os.path.normcase(entry.name)
+                            l_regexp = hidden_regexp if name.startswith('.') else visible_regexp
+                            if l_regexp and l_regexp.match(name):
+                                yield entry.path
+                        elif arg_recursive and entry.is_dir():
+                            sub_folders.append(entry.path)
+        except OSError:
+            if not arg_supress_errors:
+                warning_print("Could not open \"" + folder + "\" for file listing")
+
+        for path_filter in path_filters: # Filters like "sub/*.txt" cannot be matched against a name in this folder
+            for j in glob.glob(os.path.join(folder, path_filter)):
+                if os.path.isfile(j):
+                    yield j
+
+        for sub_folder in reversed(sub_folders): # reversed() so that the stack pops them in the order they were listed
+            sub_filters = folder_filters
+            if arg_extra_filters and sub_folder in arg_extra_filters:
+                sub_filters = tuple(dict.fromkeys(folder_filters + tuple(arg_extra_filters[sub_folder])))
+            l_stack.append((sub_folder, sub_filters))
+
+DIR_CACHE_MAX_FOLDERS = 2_000_000 # When the cache has more folders than this, the ones that were used the longest time ago are removed
+DIR_CACHE_RACY_SECONDS = 2.0 # A folder changed this recently is not cached since a change within the same mtime tick would go unnoticed
+
+@typechecked
+def _dir_cache_open(arg_cache_file: str) -> Dict[str, Any]:
+    """ Internal function. Opens (and creates if needed) the SQLite file used by iter_files() """
+    import sqlite3 # Imported here since it's only needed when the cache is used
+
+    l_db = sqlite3.connect(arg_cache_file, timeout=60)
+    l_db.execute("PRAGMA journal_mode=WAL") # Many readers and one writer at the same time
+    l_db.execute("PRAGMA synchronous=NORMAL")
+    l_db.execute("CREATE TABLE IF NOT EXISTS listing (folder TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, files TEXT NOT NULL, dirs TEXT NOT NULL, last_used INTEGER NOT NULL)")
+    l_db.execute("CREATE INDEX IF NOT EXISTS listing_last_used ON listing (last_used)")
+    l_db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    return {"db": l_db, "hits": 0, "misses": 0, "used": [], "now": int(time.time())}
+
+@typechecked
+def _dir_cache_listing(arg_cache: Dict[str, Any], arg_folder: str) -> Tuple[List[str], List[str]]:
+    """ Internal function. Returns (file names, folder names) in arg_folder, from the cache if the mtime of the folder is the same """
+    l_db = arg_cache["db"]
+    try:
+        l_mtime_ns = os.stat(arg_folder).st_mtime_ns
+    except OSError:
+        l_db.execute("DELETE FROM listing WHERE folder = ?", (arg_folder,))
+        raise
+
+    row = l_db.execute("SELECT mtime_ns, files, dirs FROM listing WHERE folder = ?", (arg_folder,)).fetchone()
+    if row and row[0] == l_mtime_ns:
+        arg_cache["hits"] += 1
+        arg_cache["used"].append((arg_cache["now"], arg_folder))
+        return (row[1].split('\0') if row[1] else []), (row[2].split('\0') if row[2] else [])
+
+    arg_cache["misses"] += 1
+    file_names: List[str] = []
+    dir_names: List[str] = []
+    with os.scandir(arg_folder) as it:
+        for entry in it:
+            if entry.is_file():
+                file_names.append(entry.name)
+            elif entry.is_dir():
+                dir_names.append(entry.name)
+
+    if time.time() - l_mtime_ns / 1e9 > DIR_CACHE_RACY_SECONDS:
+        l_db.execute("INSERT OR REPLACE INTO listing (folder, mtime_ns, files, dirs, last_used) VALUES (?, ?, ?, ?, ?)",
+                     (arg_folder, l_mtime_ns, '\0'.join(file_names), '\0'.join(dir_names), arg_cache["now"]))
+    else:
+        l_db.execute("DELETE FROM listing WHERE folder = ?", (arg_folder,))
+    return file_names, dir_names
+
+@typechecked
+def _dir_cache_close(arg_cache: Dict[str, Any], arg_debug: bool = False) -> None:
+    """ Internal function. Saves the statistics, removes old folders if the cache is too big and closes the SQLite file """
+    l_db = arg_cache["db"]
+    try:
+        l_db.executemany("UPDATE listing SET last_used = ? WHERE folder = ?", arg_cache["used"])
+        for name in ("hits", "misses"):
+            l_db.execute("INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, arg_cache[name]))
+        if arg_cache["misses"]:
+            _dir_cache_prune(l_db, DIR_CACHE_MAX_FOLDERS)
+        l_db.commit()
+        debug_lazy("Folder cache: %d hits, %d misses", arg_cache['hits'], arg_cache['misses'], arg_supress_output=not arg_debug)
+    finally:
+        l_db.close()
+
+@typechecked
+def _dir_cache_prune(arg_db: Any, arg_max_folders: int) -> int:
+    """ Internal function. Removes the folders that were used the longest time ago until there are at most arg_max_folders left """
+    l_too_many = arg_db.execute("SELECT COUNT(*) FROM listing").fetchone()[0] - arg_max_folders
+    if l_too_many <= 0:
+        return 0
+    arg_db.execute("DELETE FROM listing WHERE folder IN (SELECT folder FROM listing ORDER BY last_used LIMIT ?)", (l_too_many,))
+    return l_too_many
+
+@typechecked
+def dir_cache_clear(arg_cache_file: str, arg_folder: Union[str, None] = None) -> int:
+    """ Removes arg_folder and all its subfolders from the folder cache. If arg_folder is None then everything is removed.
+        Returns the number of folders removed
+    """
+    l_cache = _dir_cache_open(arg_cache_file)
+    l_db = l_cache["db"]
+    try:
+        if arg_folder is None:
+            res = l_db.execute("DELETE FROM listing").rowcount
+            l_db.execute("DELETE FROM stats")
+        else:
+            l_folder = os.path.abspath(arg_folder)
+            l_prefix = os.path.join(l_folder, '')
+            res = l_db.execute("DELETE FROM listing WHERE folder = ? OR substr(folder, 1, ?) = ?", (l_folder, len(l_prefix), l_prefix)).rowcount
+        l_db.commit()
+    finally:
+        l_db.close()
+    return res
+
+@typechecked
+def dir_cache_prune(arg_cache_file: str, arg_max_folders: int = DIR_CACHE_MAX_FOLDERS) -> int:
+    """ Makes sure that the folder cache has at most arg_max_folders folders. Returns the number of folders removed """
+    l_cache = _dir_cache_open(arg_cache_file)
+    l_db = l_cache["db"]
+    try:
+        res = _dir_cache_prune(l_db, arg_max_folders)
+        l_db.commit()
+    finally:
+        l_db.close()
     return res
 
+@typechecked
+def dir_cache_stats(arg_cache_file: str) -> Dict[str, int]:
+    """ Returns how the folder cache used by adv_glob(..., arg_cache_file=...) is doing.
+        hits and misses are counted since the cache was created (or cleared with dir_cache_clear())
+    """
+    if not os.path.exists(arg_cache_file):
+        return {"folders": 0, "hits": 0, "misses": 0, "size_in_bytes": 0}
+    l_cache = _dir_cache_open(arg_cache_file)
+    l_db = l_cache["db"]
+    try:
+        res = {"folders": l_db.execute("SELECT COUNT(*) FROM listing").fetchone()[0], "hits": 0, "misses": 0}
+        for name, value in l_db.execute("SELECT name, value FROM stats"):
+            res[name] = value
+    finally:
+        l_db.close()
+    res["size_in_bytes"] = os.path.getsize(arg_cache_file)
+    return res
+
+@functools.lru_cache(maxsize=256)
+def _compile_filters(arg_filters: Tuple[str, ...]) -> Tuple[Union[re.Pattern, None], Union[re.Pattern, None], Tuple[str, ...]]:
+    """ Internal function. Compiles all the filters into one regexp (the same way as fnmatch.translate() does it)
+        Returns (regexp for normal names, regexp for names starting with ., filters that contains a folder)
+        Same rules as glob.glob(): a name starting with . is only matched by a filter that also starts with .
+    """
+    visible: List[str] = []
+    hidden: List[str] = []
+    path_filters: List[str] = []
+    for f in arg_filters:
+        f = f.replace('[', '?').replace(']', '?') # glob.glob() cannot handle [ and ] in filenames, they are used as wildcard
+        if os.sep in f or (os.altsep and os.altsep in f):
+            path_filters.append(f)
+            continue
+        l_regexp = fnmatch.translate(os.path.normcase(f))
+        visible.append(l_regexp)
+        if f.startswith('.'):
+            hidden.append(l_regexp)
+    visible_regexp = re.compile('|'.join(visible)) if visible else None
+    hidden_regexp = re.compile('|'.join(hidden)) if hidden else None
+    return visible_regexp, hidden_regexp, tuple(path_filters)
+
 @typechecked
 def ensure_dir(arg_full_path: str):
     _dirs = os.path.dirname(arg_full_path)
@@ -159,6 +447,255 @@ def temp_filename(arg_debug: bool = False, arg_extension: str = "tmp") -> str:
     l_random_string: str = "".join([random.choice("abcdefghjkmnpqrstuvxyz") for _ in range(5)]) # If we have bad luck and multiple scripts download at the same time
     return f"0000_{now_nice_format(arg_filename_safe=True)}_{l_random_string}_download.{arg_extension}"
 
+DOWNLOAD_FAILED = "ERROR: CURL FAILED!" # What download_file() returns when it fails. Kept as it was when curl did the work since callers compare with it
+DOWNLOAD_RETRIES = 20 # Same as curl --retry 20
+DOWNLOAD_SPEED_LIMIT = 500 # Same as curl --speed-limit 500. Bytes per second
+DOWNLOAD_SPEED_TIME = 60 # Same as curl --speed-time 60. Seconds
+DOWNLOAD_MAX_REDIRECTS = 50 # Same as curl --max-redirs default
+DOWNLOAD_MAX_IDLE_CONNECTIONS = 16 # Number of keep-alive connections saved per host
+_DOWNLOAD_RETRY_STATUS = (408, 429, 500, 502, 503, 504) # Same as what curl --retry treats as transient errors
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+_g_http_pool: Dict[Tuple[str, str, int, str], List[http.client.HTTPConnection]] = {}
+_g_http_pool_lock = threading.Lock()
+_g_ssl_context: Union[ssl.SSLContext, None] = None
+
+class _RateLimiter:
+    ''' Internal class. Token bucket that can be shared by many downloads (and threads) at the same time '''
+
+    def __init__(self, arg_bytes_per_second: int):
+        self.bytes_per_second = arg_bytes_per_second
+        self._next_free = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, arg_num_bytes: int) -> None:
+        ''' Sleep long enough for arg_num_bytes to fit in the rate limit '''
+        if self.bytes_per_second <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next_free = max(self._next_free, now - 1.0) + arg_num_bytes / self.bytes_per_second # Allow a burst of max 1 second
+            sleep_time = self._next_free - now
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+@typechecked
+def _rate_limit_to_bytes(arg_rate_limit: Union[str, int]) -> int:
+    ''' Internal function. Converts a curl style --limit-rate (100M, 512K, 1G or just bytes) into bytes per second. 0 means no limit '''
+    if isinstance(arg_rate_limit, int):
+        return arg_rate_limit
+    l_rate = arg_rate_limit.strip().upper()
+    if not l_rate:
+        return 0
+    l_multiplier = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}.get(l_rate[-1], 1)
+    if 1 != l_multiplier:
+        l_rate = l_rate[:-1]
+    return int(float(l_rate) * l_multiplier)
+
+@typechecked
+def _parse_proxy(arg_proxy_string_to_curl: str) -> Union[urllib.parse.SplitResult, None]:
+    ''' Internal function. Takes the same proxy string as curl -x and splits it up '''
+    l_proxy = arg_proxy_string_to_curl.strip()
+    if l_proxy.startswith("-x "):
+        l_proxy = l_proxy[3:].strip()
+    if not l_proxy:
+        return None
+    if "://" not in l_proxy: # No protocol specified will be treated as HTTP proxy, same as curl
+        l_proxy = "http://" + l_proxy
+    return urllib.parse.urlsplit(l_proxy)
+
+@typechecked
+def _http_pool_get(arg_key: Tuple[str, str, int, str], arg_new_connection: bool = False) -> Tuple[http.client.HTTPConnection, bool]:
+    ''' Internal function. Returns (connection, True if it has been used before) for arg_key = (scheme, host, port, proxy) '''
+    global _g_ssl_context # pylint: disable=global-statement
+    with _g_http_pool_lock:
+        l_idle = _g_http_pool.get(arg_key)
+        if l_idle and not arg_new_connection:
+            return l_idle.pop(), True
+        if _g_ssl_context is None:
+            _g_ssl_context = ssl.create_default_context()
+
+    l_scheme, l_host, l_port, l_proxy_string = arg_key
+    l_proxy = _parse_proxy(l_proxy_string)
+    if not l_proxy:
+        if "https" == l_scheme:
+            return http.client.HTTPSConnection(l_host, l_port, timeout=DOWNLOAD_SPEED_TIME, context=_g_ssl_context), False
+        return http.client.HTTPConnection(l_host, l_port, timeout=DOWNLOAD_SPEED_TIME), False
+
+    l_proxy_port = l_proxy.port or 1080 # If the port number is not specified in the proxy string, it is assumed to be 1080 (same as curl)
+    if "https" != l_scheme: # Plain HTTP is sent to the proxy with the full URL
+        return http.client.HTTPConnection(l_proxy.hostname, l_proxy_port, timeout=DOWNLOAD_SPEED_TIME), False
+    res = http.client.HTTPSConnection(l_proxy.hostname, l_proxy_port, timeout=DOWNLOAD_SPEED_TIME, context=_g_ssl_context)
+    res.set_tunnel(l_host, l_port, headers=_proxy_headers(l_proxy))
+    return res, False
+
+@typechecked
+def _http_pool_put(arg_key: Tuple[str, str, int, str], arg_connection: http.client.HTTPConnection, arg_response: http.client.HTTPResponse) -> None:
+    ''' Internal function. Saves the connection for the next request to the same host if the server allows it '''
+    if arg_response.will_close or not arg_response.isclosed():
+        arg_connection.close()
+        return
+    with _g_http_pool_lock:
+        l_idle = _g_http_pool.setdefault(arg_key, [])
+        if len(l_idle) < DOWNLOAD_MAX_IDLE_CONNECTIONS:
+            l_idle.append(arg_connection)
+            return
+    arg_connection.close()
+
+@typechecked
+def _proxy_headers(arg_proxy: urllib.parse.SplitResult) -> Dict[str, str]:
+    ''' Internal function. Proxy-Authorization if the proxy string has user:password@ in it '''
+    if not arg_proxy.username:
+        return {}
+    import base64 # Imported here since it's only needed for proxies with a password
+    l_credentials = f"{urllib.parse.unquote(arg_proxy.username)}:{urllib.parse.unquote(arg_proxy.password or '')}"
+    return {"Proxy-Authorization": "Basic " + base64.b64encode(l_credentials.encode("utf-8")).decode("ascii")}
+
+@typechecked
+def _http_open(arg_method: str, arg_url: str, arg_headers: Dict[str, str], arg_proxy_string: str = "") -> Tuple[Tuple[str, str, int, str], http.client.HTTPConnection, http.client.HTTPResponse, str]:
+    ''' Internal function. Sends the request on a pooled connection and follows redirects (same as curl -L)
+        Returns (pool key, connection, response, the URL we ended up at). The body of the response is not read.
+    '''
+    l_url = arg_url
+    l_method = arg_method
+    l_proxy = _parse_proxy(arg_proxy_string)
+    for _ in range(DOWNLOAD_MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(l_url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Cannot download \"{l_url}\"")
+        l_port = parts.port or (443 if "https" == parts.scheme else 80)
+        l_key = (parts.scheme, parts.hostname, l_port, arg_proxy_string)
+        l_headers = dict(arg_headers)
+        l_headers["Host"] = parts.netloc.rpartition("@")[2]
+        l_target = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        if l_proxy and "http" == parts.scheme:
+            l_target = urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path or "/", parts.query, ""))
+            l_headers.update(_proxy_headers(l_proxy))
+
+        l_connection, l_reused = _http_pool_get(l_key)
+        try:
+            l_connection.request(l_method, l_target, headers=l_headers)
+            l_response = l_connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            l_connection.close()
+            if not l_reused:
+                raise
+            # The server closed the keep-alive connection while it was in the pool, try once more on a new connection
+            l_connection, _ = _http_pool_get(l_key, arg_new_connection=True)
+            l_connection.request(l_method, l_target, headers=l_headers)
+            l_response = l_connection.getresponse()
+
+        l_location = l_response.getheader("Location")
+        if l_response.status in (301, 302, 303, 307, 308) and l_location:
+            l_response.read()
+            _http_pool_put(l_key, l_connection, l_response)
+            l_url = urllib.parse.urljoin(l_url, l_location)
+            if 303 == l_response.status and "HEAD" != l_method:
+                l_method = "GET"
+            continue
+        return l_key, l_connection, l_response, l_url
+    raise http.client.HTTPException(f"Too many redirects for \"{arg_url}\"")
+
+class _LocalFileError(OSError):
+    ''' Internal class. The local file could not be written (missing folder, no access, disk full). Not retried, just like curl exit code 23 '''
+
+def _local_file_error(arg_err: OSError, arg_filename: str) -> _LocalFileError:
+    ''' Internal function. Used by _http_download() '''
+    return _LocalFileError(arg_err.errno, f'Cannot write "{arg_filename}": {arg_err.strerror or arg_err}')
+
+@typechecked
+def _http_download(arg_url: str, #pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
+                   arg_local_filename: str,
+                   arg_headers: Dict[str, str],
+                   arg_proxy_string: str = "",
+                   arg_head_only: bool = False,
+                   arg_max_num_bytes: int = 0,
+                   arg_rate_limiter: Union[_RateLimiter, None] = None,
+                   arg_retries: int = DOWNLOAD_RETRIES) -> Tuple[int, Dict[str, str]]:
+    ''' Internal function. Downloads arg_url to arg_local_filename on a pooled keep-alive connection.
+        Works like the curl command that download_file() used to run: resume what is already in the file (--continue-at -),
+        --range 0-arg_max_num_bytes, --head writes the headers to the file, --retry, --speed-limit/--speed-time and --limit-rate
+        Returns (HTTP status, response headers with lowercase names). Raises OSError or http.client.HTTPException when all retries have failed.
+        An error from the local file is raised at once as _LocalFileError (an OSError) without retries
+    '''
+    l_wait = 1.0 # curl waits one second before the first retry and then doubles the time up to 10 minutes
+    for attempt in range(arg_retries + 1):
+        l_start = 0
+        if not arg_head_only and os.path.exists(arg_local_filename):
+            l_start = os.path.getsize(arg_local_filename)
+        l_headers = dict(arg_headers)
+        if not arg_head_only:
+            if arg_max_num_bytes > 0:
+                if l_start > arg_max_num_bytes:
+                    return 206, {}
+                l_headers["Range"] = f"bytes={l_start}-{arg_max_num_bytes}"
+            elif l_start > 0:
+                l_headers["Range"] = f"bytes={l_start}-"
+
+        l_connection = None
+        try:
+            l_key, l_connection, l_response, _ = _http_open("HEAD" if arg_head_only else "GET", arg_url, l_headers, arg_proxy_string)
+            l_response_headers = {k.lower(): v for k, v in l_response.getheaders()}
+            if l_response.status in _DOWNLOAD_RETRY_STATUS and attempt < arg_retries:
+                raise http.client.HTTPException(f"HTTP {l_response.status} {l_response.reason}")
+
+            if arg_head_only:
+                l_response.read()
+                try:
+                    with io.open(arg_local_filename, "w", encoding="latin-1", newline="") as f: # Same as curl --head -o
+                        f.write(f"HTTP/{l_response.version / 10:.1f} {l_response.status} {l_response.reason}\r\n")
+                        for k, v in l_response.getheaders():
+                            f.write(f"{k}: {v}\r\n")
+                        f.write("\r\n")
+                except OSError as err:
+                    raise _local_file_error(err, arg_local_filename) from err
+                _http_pool_put(l_key, l_connection, l_response)
+                return l_response.status, l_response_headers
+
+            if l_response.status >= 400 or 304 == l_response.status: # 416 Range Not Satisfiable means that we already have the whole file. 304 Not Modified is for http_cache_get()
+                l_response.read()
+                _http_pool_put(l_key, l_connection, l_response)
+                return l_response.status, l_response_headers
+
+            l_speed_window_start = time.monotonic()
+            l_speed_window_bytes = 0
+            try:
+                f = open(arg_local_filename, "ab" if 206 == l_response.status else "wb", buffering=0) # The server might not support Range, then we start over. Unbuffered so a full disk is seen in write()
+            except OSError as err:
+                raise _local_file_error(err, arg_local_filename) from err
+            with f:
+                while True:
+                    chunk = l_response.read(_DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    try:
+                        l_view = memoryview(chunk)
+                        while l_view: # An unbuffered write() can write less than it was given
+                            l_view = l_view[f.write(l_view):]
+                    except OSError as err:
+                        raise _local_file_error(err, arg_local_filename) from err
+                    if arg_rate_limiter:
+                        arg_rate_limiter.consume(len(chunk))
+                    l_speed_window_bytes += len(chunk)
+                    l_elapsed = time.monotonic() - l_speed_window_start
+                    if l_elapsed >= DOWNLOAD_SPEED_TIME:
+                        if l_speed_window_bytes / l_elapsed < DOWNLOAD_SPEED_LIMIT:
+                            raise TimeoutError(f"Slower than {DOWNLOAD_SPEED_LIMIT} bytes per second for {DOWNLOAD_SPEED_TIME} seconds")
+                        l_speed_window_start = time.monotonic()
+                        l_speed_window_bytes = 0
+            _http_pool_put(l_key, l_connection, l_response)
+            return l_response.status, l_response_headers
+
+        except (OSError, http.client.HTTPException) as err:
+            if l_connection:
+                l_connection.close()
+            if attempt >= arg_retries or isinstance(err, _LocalFileError): # Trying again will not help if we cannot write the file
+                raise
+            warning_print(f"Download of \"{arg_url}\" failed ({err}), will retry in {l_wait:.0f} seconds. {arg_retries - attempt} retries left")
+            time.sleep(l_wait)
+            l_wait = min(l_wait * 2, 600.0)
+    raise http.client.HTTPException(f"Could not download \"{arg_url}\"") # Never reached
+
 @typechecked
 def download_file(arg_url: str, #pylint: disable=too-many-arguments
                   arg_proxy_string_to_curl: str = "",
@@ -167,9 +704,75 @@ def download_file(arg_url: str, #pylint: disable=too-many-arguments
                   arg_local_filename: Union[str, None] = None,
                   arg_check_remote_filesize: bool = False,
                   arg_max_num_bytes: int = 0,
-                  arg_rate_limit: str = "100M"
+                  arg_rate_limit: str = "100M",
+                  arg_use_curl: bool = False,
+                  arg_use_cache: bool = False
                   ) -> str:
-    """ Download a file with CURL and look like a normal web browser """
+    """ Download a file and look like a normal web browser. Connections are kept alive and reused between calls.
+        arg_use_curl runs curl instead, this is also done for SOCKS proxies since Python cannot handle them
+        arg_use_cache copies the file from http_cache_get() if HTTP_CACHE_DIR is set. Only the whole file, no --range or --head
+    """
+
+    if not arg_local_filename:
+        arg_local_filename = temp_filename()
+
+    if arg_use_cache and HTTP_CACHE_DIR and not arg_check_remote_filesize and arg_max_num_bytes <= 0 and not arg_use_curl:
+        import shutil # Imported here since it's only needed here
+        l_cached_file = http_cache_get(arg_url, arg_proxy_string_to_curl=arg_proxy_string_to_curl)
+        if not l_cached_file:
+            return DOWNLOAD_FAILED
+        shutil.copyfile(l_cached_file, arg_local_filename)
+        return arg_local_filename
+
+    l_proxy = _parse_proxy(arg_proxy_string_to_curl)
+    if arg_use_curl or (l_proxy and l_proxy.scheme.startswith("socks")):
+        return _download_file_curl(arg_url, arg_proxy_string_to_curl, arg_origin, arg_referer, arg_local_filename, arg_check_remote_filesize, arg_max_num_bytes, arg_rate_limit)
+
+    timestamped_print(f"Downloading \"{arg_url}\" --> \"{arg_local_filename}\"", arg_force_flush=True)
+    try:
+        l_status, _ = _http_download(arg_url,
+                                     arg_local_filename,
+                                     _browser_headers(arg_origin, arg_referer),
+                                     arg_proxy_string=arg_proxy_string_to_curl,
+                                     arg_head_only=arg_check_remote_filesize,
+                                     arg_max_num_bytes=arg_max_num_bytes,
+                                     arg_rate_limiter=_RateLimiter(_rate_limit_to_bytes(arg_rate_limit)))
+    except (OSError, ValueError, http.client.HTTPException) as err:
+        error_print(f'Failed to download "{arg_url}": {err}')
+        return DOWNLOAD_FAILED
+    if l_status >= 400 and not arg_check_remote_filesize and 416 != l_status:
+        error_print(f'Failed to download "{arg_url}": HTTP {l_status}')
+        return DOWNLOAD_FAILED
+    return arg_local_filename
+
+@typechecked
+def _browser_headers(arg_origin: str = "", arg_referer: str = "") -> Dict[str, str]:
+    ''' Internal function. The same headers as the curl command in _download_file_curl() sends '''
+    res = {
+        "User-Agent": __user_agent__,
+        "Accept": "*/*",
+        "Sec-Fetch-Site": "cross-site",
+        "Sec-Fetch-Mode": "cors",
+        "Sec-Fetch-Dest": "empty",
+        "Accept-Language": "en-US,en;q=0.9",
+    }
+    if arg_referer: # curl does not send empty headers
+        res["Referer"] = arg_referer
+    if arg_origin:
+        res["Origin"] = arg_origin
+    return res
+
+@typechecked
+def _download_file_curl(arg_url: str, #pylint: disable=too-many-arguments
+                        arg_proxy_string_to_curl: str = "",
+                        arg_origin: str = "",
+                        arg_referer: str = "",
+                        arg_local_filename: Union[str, None] = None,
+                        arg_check_remote_filesize: bool = False,
+                        arg_max_num_bytes: int = 0,
+                        arg_rate_limit: str = "100M"
+                        ) -> str:
+    """ Internal function. Download a file with CURL and look like a normal web browser """
 
     if not arg_local_filename:
         arg_local_filename = temp_filename()
@@ -210,7 +813,229 @@ def download_file(arg_url: str, #pylint: disable=too-many-arguments
     if 0 == os.system(curl_command):
         return arg_local_filename
     error_print(f'Curl failed to download "{arg_url}"')
-    return "ERROR: CURL FAILED!" # TODO: return None?
+    return DOWNLOAD_FAILED # TODO: return None?
+
+@typechecked
+def download_many(arg_urls: Iterable[str], #pylint: disable=too-many-arguments,too-many-locals,too-many-branches
+                  arg_dest_dir: str = ".",
+                  arg_concurrency: int = 8,
+                  arg_per_host: int = 2,
+                  arg_rate_limit: str = "100M",
+                  arg_retries: int = 5,
+                  arg_local_filenames: Union[Dict[str, str], None] = None,
+                  arg_proxy_string_to_curl: str = "",
+                  arg_origin: str = "",
+                  arg_referer: str = "",
+                  arg_use_cache: bool = False
+                  ) -> Iterator[Tuple[str, str]]:
+    ''' Download many URLs at the same time. Yields (url, local filename) as soon as each download is done.
+        The local filename is DOWNLOAD_FAILED if the download failed.
+
+        arg_concurrency is the max number of downloads at the same time and arg_per_host is the max to the same host.
+        arg_rate_limit is shared by all downloads (same format as curl --limit-rate).
+        A download that fails with a transient error is put at the back of the queue and retried later (max arg_retries times)
+        so that one slow server does not block the others.
+        arg_local_filenames is {url: filename}. URLs not in there are saved as smart_filesystem_safe_path(url) in arg_dest_dir.
+        arg_concurrency and arg_per_host below 1 are used as 1. arg_dest_dir is created if needed and a URL that is given more than once is only downloaded once.
+        arg_use_cache copies the files from http_cache_get() if HTTP_CACHE_DIR is set, same as download_file(). http_cache_get() does its own retries
+    '''
+    import shutil # Imported here since it's only needed here
+
+    arg_concurrency = max(1, arg_concurrency) # With 0 nothing could ever be started and the loop below would never end
+    arg_per_host = max(1, arg_per_host)
+    if arg_dest_dir:
+        os.makedirs(arg_dest_dir, exist_ok=True)
+    l_headers = _browser_headers(arg_origin, arg_referer)
+    l_rate_limiter = _RateLimiter(_rate_limit_to_bytes(arg_rate_limit))
+    l_pending: Dict[str, collections.deque] = {} # host --> deque of (url, attempt)
+    for url in dict.fromkeys(arg_urls): # The same URL twice would be written to the same file at the same time
+        l_pending.setdefault(urllib.parse.urlsplit(url).netloc, collections.deque()).append((url, 0))
+    l_retry_queue: List[Tuple[float, int, str, int]] = [] # heap of (time when it can be retried, tie breaker, url, attempt)
+    l_active: Dict[str, int] = {} # host --> number of downloads running
+    l_running: Dict[concurrent.futures.Future, Tuple[str, str, int]] = {} # future --> (url, host, attempt)
+    l_counter = 0
+
+    def _local_filename(arg_url: str) -> str:
+        if arg_local_filenames and arg_url in arg_local_filenames:
+            return arg_local_filenames[arg_url]
+        return os.path.join(arg_dest_dir, smart_filesystem_safe_path(arg_url))
+
+    l_use_cache = arg_use_cache and bool(HTTP_CACHE_DIR)
+
+    def _download(arg_url: str) -> Tuple[int, Dict[str, str]]:
+        if not l_use_cache:
+            return _http_download(arg_url, _local_filename(arg_url), l_headers, arg_proxy_string_to_curl, False, 0, l_rate_limiter, 0)
+        l_cached_file = http_cache_get(arg_url, arg_proxy_string_to_curl=arg_proxy_string_to_curl)
+        if not l_cached_file:
+            raise ValueError("Not in the HTTP cache and could not be downloaded") # ValueError is not retried, http_cache_get() has already done that
+        try:
+            shutil.copyfile(l_cached_file, _local_filename(arg_url))
+        except OSError as err:
+            raise _local_file_error(err, _local_filename(arg_url)) from err
+        return 200, {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=arg_concurrency) as pool:
+        while l_pending or l_retry_queue or l_running:
+            while l_retry_queue and l_retry_queue[0][0] <= time.monotonic():
+                _, _, url, attempt = heapq.heappop(l_retry_queue)
+                l_pending.setdefault(urllib.parse.urlsplit(url).netloc, collections.deque()).append((url, attempt))
+
+            for host in list(l_pending): # Start as many as we are allowed to, round robin over the hosts
+                l_queue = l_pending[host]
+                while l_queue and len(l_running) < arg_concurrency and l_active.get(host, 0) < arg_per_host:
+                    url, attempt = l_queue.popleft()
+                    l_active[host] = l_active.get(host, 0) + 1
+                    future = pool.submit(_download, url)
+                    l_running[future] = (url, host, attempt)
+                if not l_queue:
+                    del l_pending[host]
+
+            l_timeout = max(0.0, l_retry_queue[0][0] - time.monotonic()) if l_retry_queue else None
+            if not l_running:
+                time.sleep(l_timeout or 0.0)
+                continue
+            done, _ = concurrent.futures.wait(l_running, timeout=l_timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                url, host, attempt = l_running.pop(future)
+                l_active[host] -= 1
+                try:
+                    l_status, _ = future.result()
+                    l_error = f"HTTP {l_status}" if l_status >= 400 and 416 != l_status else ""
+                    l_transient = l_status in _DOWNLOAD_RETRY_STATUS
+                except (OSError, ValueError, http.client.HTTPException) as err:
+                    l_error = str(err)
+                    l_transient = not isinstance(err, (ValueError, _LocalFileError)) # Trying again will not help if we cannot write the file
+
+                if not l_error:
+                    yield url, _local_filename(url)
+                elif l_transient and attempt < arg_retries:
+                    l_wait = min(2.0 ** attempt, 600.0) # Same back off as download_file()
+                    warning_print(f"Download of \"{url}\" failed ({l_error}), will retry in {l_wait:.0f} seconds. {arg_retries - attempt} retries left")
+                    l_counter += 1
+                    heapq.heappush(l_retry_queue, (time.monotonic() + l_wait, l_counter, url, attempt + 1))
+                else:
+                    error_print(f'Failed to download "{url}": {l_error}')
+                    yield url, DOWNLOAD_FAILED
+
+HTTP_CACHE_DIR: str = os.environ.get("HARDING_UTILS_HTTP_CACHE_DIR", "") # Where http_cache_get() saves responses. Empty means that text_read_whole_file() does not use the cache
+HTTP_CACHE_TTL: float = float(os.environ.get("HARDING_UTILS_HTTP_CACHE_TTL", "0")) # Seconds a cached response is used without asking the server. 0 means always ask (If-None-Match / If-Modified-Since)
+HTTP_CACHE_MAX_BYTES: int = int(os.environ.get("HARDING_UTILS_HTTP_CACHE_MAX_BYTES", str(512 * 1024 * 1024))) # When the cache is bigger than this, the least recently used responses are removed
+
+@typechecked
+def http_cache_get(arg_url: str,
+                   arg_cache_dir: Union[str, None] = None,
+                   arg_ttl: Union[float, None] = None,
+                   arg_max_bytes: Union[int, None] = None,
+                   arg_proxy_string_to_curl: str = "") -> Union[str, None]:
+    ''' Returns the filename of a local copy of arg_url that is up to date. Returns None if it could not be downloaded.
+        The server is asked with If-None-Match / If-Modified-Since and if it answers 304 Not Modified the copy we have is used.
+        Within arg_ttl seconds of the last check the server is not asked at all.
+        If the server cannot be reached, the old copy is used (with a warning).
+        arg_cache_dir, arg_ttl and arg_max_bytes default to HTTP_CACHE_DIR, HTTP_CACHE_TTL and HTTP_CACHE_MAX_BYTES
+    '''
+    import hashlib # Imported here since it's only needed for the cache
+
+    l_cache_dir = arg_cache_dir or HTTP_CACHE_DIR
+    if not l_cache_dir:
+        raise ValueError("No cache folder given and HTTP_CACHE_DIR is not set")
+    l_ttl = HTTP_CACHE_TTL if arg_ttl is None else arg_ttl
+    os.makedirs(l_cache_dir, exist_ok=True)
+    l_base = os.path.join(l_cache_dir, hashlib.sha1(arg_url.encode("utf-8")).hexdigest())
+    l_body_file = l_base + ".body"
+    l_meta_file = l_base + ".meta.json"
+
+    l_meta: Dict[str, Any] = {}
+    if os.path.exists(l_body_file) and os.path.exists(l_meta_file):
+        try:
+            with io.open(l_meta_file, "r", encoding="utf-8") as f:
+                l_meta = json.load(f)
+        except (OSError, ValueError):
+            l_meta = {}
+
+    if l_meta and l_ttl > 0 and time.time() - l_meta.get("checked", 0) < l_ttl:
+        os.utime(l_body_file) # The mtime of the body is used to know what was least recently used
+        return l_body_file
+
+    l_headers = _browser_headers()
+    if l_meta.get("etag"):
+        l_headers["If-None-Match"] = l_meta["etag"]
+    if l_meta.get("last_modified"):
+        l_headers["If-Modified-Since"] = l_meta["last_modified"]
+
+    l_tmp_file = l_base + "." + temp_filename()
+    try:
+        l_status, l_response_headers = _http_download(arg_url, l_tmp_file, l_headers, arg_proxy_string=arg_proxy_string_to_curl)
+    except (OSError, ValueError, http.client.HTTPException) as err:
+        file_delete(l_tmp_file)
+        if l_meta:
+            warning_print(f"Could not check if \"{arg_url}\" has changed ({err}), using the cached copy from {l_meta.get('downloaded', '?')}")
+            return l_body_file
+        error_print(f'Failed to download "{arg_url}": {err}')
+        return None
+
+    if 304 == l_status and l_meta:
+        file_delete(l_tmp_file)
+    elif 304 == l_status: # We did not ask for a 304 so nothing was downloaded and there is no copy to use
+        file_delete(l_tmp_file)
+        error_print(f'Failed to download "{arg_url}": HTTP 304 Not Modified but there is no cached copy')
+        return None
+    elif l_status >= 400:
+        file_delete(l_tmp_file)
+        error_print(f'Failed to download "{arg_url}": HTTP {l_status}')
+        return None
+    else:
+        os.replace(l_tmp_file, l_body_file)
+        l_meta = {"url": arg_url,
+                  "etag": l_response_headers.get("etag", ""),
+                  "last_modified": l_response_headers.get("last-modified", ""),
+                  "downloaded": now_nice_format()}
+
+    l_meta["checked"] = time.time()
+    with io.open(l_meta_file + ".tmp", "w", encoding="utf-8", newline="\n") as f:
+        json.dump(l_meta, f)
+    os.replace(l_meta_file + ".tmp", l_meta_file)
+    os.utime(l_body_file)
+    if 304 != l_status:
+        http_cache_evict(l_cache_dir, HTTP_CACHE_MAX_BYTES if arg_max_bytes is None else arg_max_bytes, arg_keep=l_base) # Never the file we return, even if it alone is bigger than the max
+    return l_body_file
+
+@typechecked
+def http_cache_evict(arg_cache_dir: Union[str, None] = None, arg_max_bytes: int = 0, arg_keep: Union[str, None] = None) -> int:
+    ''' Removes the least recently used responses until the cache is at most arg_max_bytes big. Returns the number of responses removed.
+        arg_keep is the cache filename without .body of a response that must not be removed (used by http_cache_get() for the response it returns)
+    '''
+    l_cache_dir = arg_cache_dir or HTTP_CACHE_DIR
+    if not l_cache_dir or not os.path.isdir(l_cache_dir):
+        return 0
+    l_entries: List[Tuple[float, int, str]] = [] # (last used, size of body + meta, base filename)
+    l_total = 0
+    with os.scandir(l_cache_dir) as it:
+        for entry in it:
+            if not entry.name.endswith(".body"):
+                continue
+            l_base = entry.path[:-len(".body")]
+            l_stat = entry.stat()
+            l_size = l_stat.st_size + (os.path.getsize(l_base + ".meta.json") if os.path.exists(l_base + ".meta.json") else 0)
+            l_entries.append((l_stat.st_mtime, l_size, l_base))
+            l_total += l_size
+
+    res = 0
+    l_entries.sort()
+    for _, l_size, l_base in l_entries:
+        if l_total <= arg_max_bytes:
+            break
+        if arg_keep and os.path.normcase(os.path.abspath(l_base)) == os.path.normcase(os.path.abspath(arg_keep)):
+            continue
+        file_delete(l_base + ".body")
+        file_delete(l_base + ".meta.json")
+        l_total -= l_size
+        res += 1
+    return res
+
+@typechecked
+def http_cache_clear(arg_cache_dir: Union[str, None] = None) -> int:
+    ''' Removes everything in the HTTP cache. Returns the number of responses removed '''
+    return http_cache_evict(arg_cache_dir, 0)
 
 @typechecked
 def now_nice_format(arg_filename_safe: bool = False, arg_utc: bool = False) -> str:
@@ -230,13 +1055,29 @@ def timestamped_line(arg_str: str = "") -> str:
 def timestamped_print(arg_str: str = "", arg_file = sys.stdout, arg_force_flush: bool = False):
     print(timestamped_line(arg_str), file=arg_file, flush=arg_force_flush)
 
+LOG_PRINT_ENABLED = True # Set to False to make log_print(), warning_print(), error_print() and success_print() return directly
+
+_g_code_names: Dict[Any, str] = {} # code object --> "module.function" (or "file.py" for code at module level) used by log_print()
+
 @typechecked
 def _file_and_line_number(arg_num_function_away: int = 2) -> _inspect.Traceback:
-    ''' Internal function. Used in log_print() '''
-    callerframerecord = _inspect.stack()[arg_num_function_away]      # 0 represents this line
-    frame = callerframerecord[0]                                     # 1 represents line at caller and so on
-    info = _inspect.getframeinfo(frame)                              # info.filename, info.function, info.lineno
-    return info
+    ''' Internal function. Returns the same as inspect.getframeinfo() but without reading the source code '''
+    frame = _caller_frame(arg_num_function_away) # 0 represents this line, 1 represents line at caller and so on
+    return _inspect.Traceback(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name, None, None)
+
+@typechecked
+def _caller_name_and_line_number(arg_num_function_away: int = 2) -> Tuple[str, int]:
+    ''' Internal function. Used in log_print(). Only looks at the one frame it needs (inspect.stack() builds info about all of them) '''
+    frame = _caller_frame(arg_num_function_away) # 0 represents this line, 1 represents line at caller and so on
+    code = frame.f_code
+    res = _g_code_names.get(code)
+    if res is None:
+        if code.co_name == "<module>":
+            res = os.path.basename(code.co_filename)
+        else:
+            res = f"{os.path.splitext(os.path.basename(code.co_filename))[0]}.{code.co_name}"
+        _g_code_names[code] = res
+    return res, frame.f_lineno
 
 @typechecked
 def log_print(arg_string: str, #pylint: disable=too-many-arguments
@@ -247,62 +1088,88 @@ def log_print(arg_string: str, #pylint: disable=too-many-arguments
               arg_num_function_away: int = 2
               ) -> None:
     ''' Used for outputing code trace while development TODO: replace this with a real logger code? '''
-    if arg_actually_log:
-        info = _file_and_line_number(arg_num_function_away)
-        function_name = info.function
-        if function_name == "<module>":
-            function_name = os.path.basename(info.filename)
-        else:
-            function_name = f"{os.path.splitext(os.path.basename(info.filename))[0]}.{function_name}"
-        log_line = f"{arg_type}: {function_name}:{info.lineno} --> {arg_string}"
+    if not arg_actually_log or not LOG_PRINT_ENABLED:
+        return
+    function_name, line_number = _caller_name_and_line_number(arg_num_function_away)
+    log_line = f"{arg_type}: {function_name}:{line_number} --> {arg_string}"
 
-        timestamped_print(arg_str=log_line, arg_file=arg_file, arg_force_flush=arg_force_flush)
+    timestamped_print(arg_str=log_line, arg_file=arg_file, arg_force_flush=arg_force_flush)
 
 _ExpType = TypeVar('_ExpType')
 @typechecked
 def debug(arg_exp: _ExpType, arg_supress_output: bool = False, arg_out_handle = sys.stderr) -> _ExpType:
-    ''' Modded version of pydbg. TODO: Maybe replace this with iceream? https://github.com/gruns/icecream    pip install icecream '''
+    ''' Modded version of pydbg. TODO: Maybe replace this with iceream? https://github.com/gruns/icecream    pip install icecream
+        If the argument is expensive to create (f-strings, str() on big lists) then use debug_lazy() instead
+    '''
     if arg_supress_output:
         return arg_exp
 
-    for frame in _inspect.stack():
-        if not frame.code_context:
-            break
-        line = frame.code_context[0]
-        start = line.find('debug(') + 1
-
-        if start:
-            exp_str = find_matching_brackets(line[start - 1:], arg_opening_brackets='(')
-            if exp_str:
-                exp_str = exp_str[6:-1] # Strip  the 'debug(' and the trailing ')'
-
-            # Remove the arguments to this function (if there are any)
-            all_parts = exp_str.split(',')
-            if 1 == len(all_parts):
-                exp_res = all_parts[0]
-            else:
-                if all_parts:
-                    exp_res = ""
-                    for part in all_parts:
-                        exp_res += part + ','
-                        if find_matching_brackets(exp_res[:-1], arg_opening_brackets='('):
-                            exp_res = exp_res[:-1]
-                            break
+    frame = _caller_frame(1)
+    while frame:
+        filename = frame.f_code.co_filename
+        lineno = frame.f_lineno
+        exp_res = _g_debug_expressions.get((filename, lineno))
+        if exp_res is None:
+            line = linecache.getline(filename, lineno)
+            if not line:
+                break
+            if 'debug(' not in line:
+                frame = frame.f_back
+                continue
+            exp_res = _debug_expression(line)
+            _g_debug_expressions[(filename, lineno)] = exp_res
+
+        timestamped_print(
+            f"DEBUG: {filename}:{lineno}: {exp_res} --> {arg_exp!r}",
+            arg_file=arg_out_handle,
+        )
+        break
 
-            exp_res = exp_res.strip()
+    return arg_exp
 
-            # import ast
-            # a = ast.parse(exp_res)
-            # b = ast.dump(a)
-            # print(b, file=arg_out_handle)
+_g_debug_expressions: Dict[Tuple[str, int], str] = {} # (filename, line number) --> the expression in the debug() call on that line
 
-            timestamped_print(
-                f"DEBUG: {frame.filename}:{frame.lineno}: {exp_res} --> {arg_exp!r}",
-                arg_file=arg_out_handle,
-            )
-            break
+@typechecked
+def _debug_expression(arg_line: str) -> str:
+    ''' Internal function. Takes a line of source code with a call to debug() and returns the first argument as a str '''
+    start = arg_line.find('debug(') + 1
+    exp_str = find_matching_brackets(arg_line[start - 1:], arg_opening_brackets='(')
+    if exp_str:
+        exp_str = exp_str[6:-1] # Strip  the 'debug(' and the trailing ')'
+
+    # Remove the arguments to this function (if there are any)
+    all_parts = exp_str.split(',')
+    exp_res = all_parts[0]
+    if len(all_parts) > 1:
+        exp_res = ""
+        for part in all_parts:
+            exp_res += part + ','
+            if find_matching_brackets(exp_res[:-1], arg_opening_brackets='('):
+                exp_res = exp_res[:-1]
+                break
+
+    # import ast
+    # a = ast.parse(exp_res)
+    # b = ast.dump(a)
+    # print(b, file=arg_out_handle)
+    return exp_res.strip()
 
-    return arg_exp
+@typechecked
+def debug_lazy(arg_message: Union[str, Callable[[], Any]], *arg_format_args, arg_supress_output: bool = False, arg_out_handle = sys.stderr) -> None:
+    ''' Same as debug() but nothing is formatted when arg_supress_output is True.
+        arg_message is either a function that returns what to print or a format string that is used with % and arg_format_args
+        Example: debug_lazy("File filters = %s", file_filters, arg_supress_output=not arg_debug)
+    '''
+    if arg_supress_output:
+        return
+    if callable(arg_message):
+        message = arg_message()
+    elif arg_format_args:
+        message = arg_message % arg_format_args
+    else:
+        message = arg_message
+    frame = _caller_frame(1)
+    timestamped_print(f"DEBUG: {frame.f_code.co_filename}:{frame.f_lineno}: {message}", arg_file=arg_out_handle)
 
 @typechecked
 def console_color(arg_string: str, arg_color: str = "OKGREEN") -> str:
@@ -330,14 +1197,20 @@ def console_color(arg_string: str, arg_color: str = "OKGREEN") -> str:
 
 @typechecked
 def warning_print(arg_string: str):
+    if not LOG_PRINT_ENABLED:
+        return
     log_print(arg_type="WARNING", arg_string=console_color(arg_string, arg_color="WARNING"), arg_num_function_away=3)
 
 @typechecked
 def error_print(arg_string: str):
+    if not LOG_PRINT_ENABLED:
+        return
     log_print(arg_type="ERROR", arg_string=console_color(arg_string, arg_color="FAIL"), arg_num_function_away=3)
 
 @typechecked
 def success_print(arg_string: str):
+    if not LOG_PRINT_ENABLED:
+        return
     log_print(arg_type="SUCCESS", arg_string=console_color(arg_string, arg_color="HEADER"), arg_num_function_away=3)
     # timestamped_print(console_color(f"SUCCESS {arg_string}", "HEADER"))
 
@@ -347,12 +1220,7 @@ def dict_count(arg_dict: dict, arg_key) -> dict:
     ex: dict_count({"1001": {"name": "Spongebob", "age": 35}, "1002": {"name": "Patrick", "age": 35}, "1003": {"name": "Squidward", "age": 43}}, "age")
     """
 
-    res: Dict[Any, int] = {}
-    for v in arg_dict.values():
-        for k2, v2 in v.items():
-            if arg_key == k2:
-                res[v2] = res.get(v2, 0) + 1
-    return res
+    return dict(collections.Counter(v[arg_key] for v in arg_dict.values() if arg_key in v)) # One lookup per record instead of looking at every field
 
 @typechecked
 def dict_get_key_from_value(arg_dict: dict, arg_value):
@@ -361,19 +1229,95 @@ def dict_get_key_from_value(arg_dict: dict, arg_value):
             return k
     return None
 
+NATURAL_SORT_CACHE_SIZE = 64 * 1024 # How many folder keys natural_sorted() remembers between calls
+_g_natural_split = re.compile(r'([0-9]+)').split
+
+def _natural_parts(arg_str: str) -> List[str]:
+    ''' Internal function. "file10.txt" --> ["file", "10", ".txt"]. The numbers are always at odd indexes '''
+    return _g_natural_split(arg_str if arg_str.isascii() else unicodedata.normalize("NFD", arg_str)) # Same as natsort: é is e + accent so it sorts next to e
+
+class _NotNaturalStrKey(TypeError):
+    ''' Internal class. Raised by _natural_str_key() so natural_sorted() does not mistake a TypeError from the caller's arg_key for it '''
+
+def _natural_str_key(arg_str: str) -> str:
+    ''' Internal function. The natural order packed into one str so sorting compares str in C instead of tuples.
+        Each text part ends with \\0 (so a shorter text is smaller) and each number is its length + the digits without leading zeros (so 9 < 10).
+        Gives the same order as natural_sort_key(). Raises _NotNaturalStrKey (a TypeError) if it cannot be used so the caller can use natural_sort_key() instead
+    '''
+    if not isinstance(arg_str, str) or "\0" in arg_str:
+        raise _NotNaturalStrKey("Only str without \\0 can have a str key")
+    l_slash = max(arg_str.rfind("/"), arg_str.rfind("\\"))
+    if l_slash > 0: # Many paths are in the same folder, so the key of the folder is only made once. The / is text so the two parts can be glued together
+        return _natural_folder_key(arg_str[:l_slash])[:-1] + _natural_encode(arg_str[l_slash:])
+    return _natural_encode(arg_str)
+
+@functools.lru_cache(maxsize=NATURAL_SORT_CACHE_SIZE)
+def _natural_folder_key(arg_folder: str) -> str:
+    ''' Internal function. Cached _natural_encode() '''
+    return _natural_encode(arg_folder)
+
+def _natural_encode(arg_str: str) -> str:
+    ''' Internal function. Does the work for _natural_str_key() '''
+    l_parts = _natural_parts(arg_str)
+    for i in range(1, len(l_parts), 2):
+        l_digits = l_parts[i].lstrip("0")
+        l_parts[i] = chr(len(l_digits) + 1) + l_digits
+    for i in range(0, len(l_parts), 2):
+        l_parts[i] += "\0"
+    return "".join(l_parts)
+
+def natural_sort_key(arg_value: Any) -> Any: # Not @typechecked since it is called once for every item that is sorted
+    ''' Key for sorted() so "file2" comes before "file10". Same order as natsort.natsorted() but natsort is not needed.
+        "file10.txt" --> ("file", 10, ".txt"). Numbers sort as if they were strings with only digits and tuples (like dict.items()) are compared item by item
+    '''
+    if isinstance(arg_value, str):
+        l_parts: List[Any] = _natural_parts(arg_value)
+        l_parts[1::2] = map(int, l_parts[1::2])
+        return tuple(l_parts)
+    if isinstance(arg_value, (int, float)) and not isinstance(arg_value, bool):
+        return ("", arg_value)
+    if isinstance(arg_value, tuple):
+        return tuple(natural_sort_key(value) for value in arg_value)
+    return arg_value
+
+@typechecked
+def natural_sorted(arg_items: Iterable[Any], arg_key: Union[Callable[[Any], Any], None] = None, arg_reverse: bool = False, arg_chunk_size: int = 0) -> List[Any]:
+    ''' sorted() in natural order: file1, file2, file10 instead of file1, file10, file2. arg_key picks what to sort on, just like sorted()
+        arg_chunk_size > 0 sorts arg_items a chunk at a time while they are being read (for example from iter_glob()) and merges the chunks at the end
+    '''
+    l_items = arg_items if isinstance(arg_items, list) else list(arg_items) if arg_chunk_size <= 0 else None
+    l_key: Callable[[Any], Any] = _natural_str_key if arg_key is None else lambda item: _natural_str_key(arg_key(item))
+    try:
+        if l_items is not None:
+            return sorted(l_items, key=l_key, reverse=arg_reverse)
+        l_chunks: List[List[Any]] = []
+        l_iter = iter(arg_items)
+        while True:
+            l_chunk = list(itertools.islice(l_iter, arg_chunk_size))
+            if not l_chunk:
+                break
+            l_chunks.append(l_chunk) # Before the sort so the items are still there for the fallback if the sort fails
+            l_chunk.sort(key=l_key, reverse=arg_reverse)
+        return list(heapq.merge(*l_chunks, key=l_key, reverse=arg_reverse)) if len(l_chunks) > 1 else (l_chunks[0] if l_chunks else [])
+    except _NotNaturalStrKey: # Not only str, use the tuple keys that can compare numbers and tuples too
+        if l_items is None:
+            l_items = list(itertools.chain.from_iterable(l_chunks)) + list(l_iter)
+        return sorted(l_items, key=natural_sort_key if arg_key is None else lambda item: natural_sort_key(arg_key(item)), reverse=arg_reverse)
+
+@typechecked
+def natural_merge(*arg_sorted_iterables: Iterable[Any], arg_key: Union[Callable[[Any], Any], None] = None, arg_reverse: bool = False) -> Iterator[Any]:
+    ''' Merges iterables that are already natural_sorted() into one sorted stream. Only one item from each iterable is kept in memory '''
+    if 1 == len(arg_sorted_iterables):
+        return iter(arg_sorted_iterables[0])
+    return heapq.merge(*arg_sorted_iterables, key=natural_sort_key if arg_key is None else lambda item: natural_sort_key(arg_key(item)), reverse=arg_reverse)
+
 @typechecked
 def dict_sort(arg_dict: dict, arg_sort_by_value: bool = False, arg_desc: bool = False) -> dict:
     ''' Returns a new sorted dictionary '''
-    res = {}
-    sort_function = sorted
-    if use_natsort:
-        sort_function = natsort.natsorted
     if arg_sort_by_value:
-        res = dict(sort_function(arg_dict.items(), key=lambda item: item[1])) # Sort by value ( lower -> higher )
+        res = dict(natural_sorted(arg_dict.items(), arg_key=lambda item: item[1])) # Sort by value ( lower -> higher )
     else:
-        _list = sort_function(arg_dict.items())
-        for _t in _list:
-            res[_t[0]] = _t[1]
+        res = dict(natural_sorted(arg_dict.items()))
 
     if arg_desc:
         res = {k: res[k] for k in reversed(res)} # Just reverse the dict
@@ -389,35 +1333,176 @@ def dict_move_to_start(arg_dict: dict, arg_key) -> dict:
         res[k] = v
     return res
 
+_g_json_pretty_encoder = json.JSONEncoder(ensure_ascii=False, indent=4, default=str) # The one place where the pretty JSON format is decided
+
 @typechecked
 def dict_to_json_string_pretty(arg_dict: Union[dict, list], arg_as_html: bool = False) -> str:
-    res = json.dumps(arg_dict, ensure_ascii=False, indent=4, default=str)
+    res = _g_json_pretty_encoder.encode(arg_dict)
     if arg_as_html:
         res = res.replace("\n", "<br/>\n")
     return res
 
 @typechecked
-def dict_dump_to_json_file(arg_dict: Union[dict, list], arg_filename: str) -> bool:
+def dict_to_json_bytes_compact(arg_dict: Union[dict, list]) -> bytes:
+    ''' UTF-8 JSON without any whitespace. Uses orjson or ujson if installed (see JSON_BACKEND) '''
+    if "orjson" == JSON_BACKEND:
+        try: # Let datetime and dataclasses go to default=str so we get the same result as the json lib
+            return orjson.dumps(arg_dict, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS)
+        except TypeError: # Integers bigger than 64 bits and such
+            pass
+    elif "ujson" == JSON_BACKEND:
+        try:
+            return ujson.dumps(arg_dict, ensure_ascii=False, escape_forward_slashes=False, default=str).encode("utf-8")
+        except (TypeError, OverflowError):
+            pass
+    return json.dumps(arg_dict, ensure_ascii=False, separators=(',', ':'), default=str).encode("utf-8")
+
+@typechecked
+def dict_dump_to_json_file(arg_dict: Union[dict, list], arg_filename: str, arg_compact: bool = False) -> bool:
+    ''' Saves arg_dict as JSON. The file is written to a temp file that is renamed to arg_filename, so the old file is there until the new one is complete.
+        The default is the same format as dict_to_json_string_pretty() which is written a chunk at a time instead of creating one big string first.
+        arg_compact is for files that are only read by programs: no whitespace and written with JSON_BACKEND.
+        If arg_filename ends with .gz, .xz or .zst then the file is compressed while it is written (see file_open())
+    '''
     if isinstance(arg_dict, str) and isinstance(arg_filename, dict): # Sometimes I mix up the order, if I do then just make the code fix it for me
         arg_dict, arg_filename = arg_filename, arg_dict
 
     if not (isinstance(arg_dict, (dict, list))) or not isinstance(arg_filename, str):
         raise ValueError(f'Invalid arguments. arg_dict is of type: {type(arg_dict)} and arg_filename is of type: {type(arg_filename)}')
 
-    data = dict_to_json_string_pretty(arg_dict)
-    with io.open(arg_filename, "w", encoding="utf-8", newline="\n") as f:
-        f.write(data)
+    l_tmp_filename = f"{arg_filename}.{''.join(random.choice('abcdefghjkmnpqrstuvxyz') for _ in range(5))}.tmp" # Same folder so os.replace() is a rename
+    try:
+        l_compression = file_compression(arg_filename, arg_check_content=False) # The temp file has another extension
+        if arg_compact:
+            with file_open(l_tmp_filename, "wb", arg_compression=l_compression) as fb:
+                fb.write(dict_to_json_bytes_compact(arg_dict))
+        elif l_compression:
+            with file_open(l_tmp_filename, "w", arg_compression=l_compression) as f:
+                f.writelines(_g_json_pretty_encoder.iterencode(arg_dict)) # TextIOWrapper collects the small pieces before they are compressed
+        else:
+            with io.open(l_tmp_filename, "w", encoding="utf-8", newline="\n", buffering=1024 * 1024) as f:
+                f.writelines(_g_json_pretty_encoder.iterencode(arg_dict))
+        os.replace(l_tmp_filename, arg_filename)
+    finally:
+        file_delete(l_tmp_filename)
     return True
 
 @typechecked
 def dict_load_json_file(arg_filename_or_url: str) -> Union[Dict, None]:
-    ''' Takes a filename or URL and parse it as a dict '''
+    ''' Takes a filename or URL and parse it as a dict. gzip, xz and zstd files are decompressed '''
 
     file_content = text_read_whole_file(arg_filename_or_url)
     if not file_content:
         return None
     return json.loads(file_content)
 
+class _JsonStream:
+    ''' Internal class. Pull parser used by json_iter_file(). Only the part of the file that is being parsed is kept in memory '''
+
+    _WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, arg_file: Any, arg_chunk_size: int):
+        self._file = arg_file
+        self._chunk_size = arg_chunk_size
+        self._decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, arg_num_chars: int) -> bool:
+        ''' Reads more from the file. Returns False if there is nothing more to read '''
+        if self.eof:
+            return False
+        if self.pos > len(self.buf) // 2: # Throw away what has been parsed, but not too often since that copies the rest of the buffer
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self._file.read(arg_num_chars)
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def peek(self) -> str:
+        ''' Skips whitespace and returns the next char without consuming it. Returns "" at the end of the file '''
+        while True:
+            self.pos = self._WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill(self._chunk_size):
+                return ""
+
+    def expect(self, arg_char: str) -> None:
+        if self.peek() != arg_char:
+            raise ValueError(f"Expected '{arg_char}' but found '{self.peek()}' in the JSON")
+        self.pos += 1
+
+    def value(self) -> Any:
+        ''' Decodes the next JSON value (which can be a big object or array) '''
+        self.peek()
+        l_read_size = self._chunk_size
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self.buf, self.pos)
+                if self.eof or (end < len(self.buf) and self.buf[end] not in "0123456789.eE+-"): # A number at the end of the buffer might continue in the next chunk
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill(l_read_size)
+            l_read_size *= 2 # Makes the retries of a value bigger than the buffer linear instead of quadratic
+
+    def items(self, arg_path: Tuple[Union[str, int], ...] = ()) -> Iterator[Any]:
+        ''' Yields the items in the array or (key, value) in the object that starts here. arg_path is keys/indexes to walk down first '''
+        ch = self.peek()
+        if ch not in ('[', '{'):
+            if not arg_path and ch:
+                yield self.value()
+            return
+
+        self.pos += 1
+        l_closing = ']' if '[' == ch else '}'
+        if self.peek() == l_closing:
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            key: Union[str, int] = index
+            if '{' == ch:
+                key = self.value()
+                self.expect(':')
+            if arg_path and key == arg_path[0]:
+                yield from self.items(arg_path[1:])
+                return # No need to parse the rest of the file
+            if arg_path:
+                self.value() # Skip it
+            elif '{' == ch:
+                yield key, self.value()
+            else:
+                yield self.value()
+            index += 1
+            l_next = self.peek()
+            self.pos += 1
+            if l_next == l_closing:
+                return
+            if ',' != l_next:
+                raise ValueError(f"Expected ',' or '{l_closing}' but found '{l_next}' in the JSON")
+
+@typechecked
+def json_iter_file(arg_filename: str, arg_path: Union[List[Union[str, int]], Tuple[Union[str, int], ...], None] = None, arg_chunk_size: int = 1024 * 1024) -> Iterator[Any]:
+    ''' Reads a JSON file a chunk at a time and yields each item in the top-level array, or (key, value) for each key in the top-level object.
+        Only the item that is being parsed is kept in memory, so this works on files that are much bigger than dict_load_json_file() can handle.
+        arg_path is keys (or list indexes) to walk down before starting to yield. Example: ["json_data"] for a file from harding_json
+        Use "-" for stdin
+    '''
+    l_path = tuple(arg_path) if arg_path else ()
+    if "-" == arg_filename:
+        yield from _JsonStream(sys.stdin, arg_chunk_size).items(l_path)
+        return
+    with file_open(arg_filename, "r", arg_newline="") as f: # Compressed files are decompressed a chunk at a time
+        yield from _JsonStream(f, arg_chunk_size).items(l_path)
+
 @typechecked
 def dict_list_to_massive_dict(arg_list: List[Any], arg_key) -> Union[Dict, None]:
     ''' Converts a list of dicts --> one massive dict '''
@@ -430,6 +1515,88 @@ def dict_list_to_massive_dict(arg_list: List[Any], arg_key) -> Union[Dict, None]
         res[str(item[arg_key])] = item # There is a "bug" in Python that JSON keys is always string but Python can have ints as keys: https://stackoverflow.com/a/1451857
     return res
 
+COLUMN_MISSING: Any = object() # The value in a column for a record that does not have that field
+COLUMNS_KEY = "__key__" # The column with the keys when columns_from_dicts() got a dict of dicts
+
+@typechecked
+def columns_from_dicts(arg_data: Union[dict, list], arg_fields: Union[List[Any], None] = None) -> Dict[Any, Any]:
+    ''' Converts a dict of dicts (or a list of dicts) into one column per field: {field: [value in record 0, value in record 1, ...]}
+        This is done once and then columns_count(), columns_sort() and columns_index() work on a whole column at a time.
+        Columns with only int or only float are stored as array.array (8 bytes per value). A record without a field has COLUMN_MISSING in that column.
+        The keys of a dict of dicts are in the column COLUMNS_KEY. arg_fields is the fields to keep, default is all fields.
+        ex: columns_count(columns_from_dicts({"1001": {"name": "Spongebob", "age": 35}, "1002": {"name": "Patrick", "age": 35}}), "age") --> {35: 2}
+    '''
+    res: Dict[Any, Any] = {}
+    if isinstance(arg_data, dict):
+        res[COLUMNS_KEY] = list(arg_data.keys())
+        l_records = list(arg_data.values())
+    else:
+        l_records = arg_data
+    if arg_fields is None:
+        arg_fields = list(dict.fromkeys(itertools.chain.from_iterable(l_records))) # All fields in the order they are first seen
+    for field in arg_fields:
+        l_column = [record.get(field, COLUMN_MISSING) for record in l_records]
+        l_types = set(map(type, l_column))
+        try:
+            if {int} == l_types:
+                l_column = array.array('q', l_column)
+            elif {float} == l_types:
+                l_column = array.array('d', l_column)
+        except OverflowError: # Integers bigger than 64 bits stay in a list
+            pass
+        res[field] = l_column
+    return res
+
+@typechecked
+def columns_count(arg_columns: Dict[Any, Any], arg_field) -> dict:
+    ''' Same result as dict_count() but on a column from columns_from_dicts() '''
+    res = collections.Counter(arg_columns[arg_field])
+    res.pop(COLUMN_MISSING, None)
+    return dict(res)
+
+@typechecked
+def columns_sort(arg_columns: Dict[Any, Any], arg_field, arg_desc: bool = False) -> List[int]:
+    ''' Returns the record numbers sorted by the value in arg_field. Records that do not have arg_field are last. Use with columns_take() '''
+    l_column = arg_columns[arg_field]
+    l_rows = range(len(l_column))
+    l_missing = [i for i in l_rows if l_column[i] is COLUMN_MISSING] if not isinstance(l_column, array.array) else []
+    if l_missing:
+        l_missing_set = set(l_missing)
+        l_rows = [i for i in l_rows if i not in l_missing_set]
+    return sorted(l_rows, key=l_column.__getitem__, reverse=arg_desc) + l_missing
+
+@typechecked
+def columns_take(arg_columns: Dict[Any, Any], arg_rows: List[int]) -> Dict[Any, Any]:
+    ''' New columns with only the records in arg_rows, in that order '''
+    res: Dict[Any, Any] = {}
+    for field, column in arg_columns.items():
+        l_new = [column[i] for i in arg_rows]
+        res[field] = array.array(column.typecode, l_new) if isinstance(column, array.array) else l_new
+    return res
+
+@typechecked
+def columns_index(arg_columns: Dict[Any, Any], arg_field) -> Dict[str, int]:
+    ''' str(value in arg_field) --> record number. If many records have the same value, the last one wins (as in dict_list_to_massive_dict()) '''
+    l_column = arg_columns[arg_field]
+    return {str(value): i for i, value in enumerate(l_column) if value is not COLUMN_MISSING}
+
+@typechecked
+def columns_to_dicts(arg_columns: Dict[Any, Any], arg_key_field=None) -> Union[dict, list]:
+    ''' Back to the shape columns_from_dicts() got: a dict of dicts if there is a COLUMNS_KEY column, else a list of dicts.
+        With arg_key_field it is a dict with str(value in arg_key_field) as keys, same as dict_list_to_massive_dict()
+    '''
+    l_fields = [field for field in arg_columns if COLUMNS_KEY != field]
+    l_rows = zip(*(arg_columns[field] for field in l_fields))
+    if any(not isinstance(arg_columns[field], array.array) and COLUMN_MISSING in arg_columns[field] for field in l_fields):
+        l_records = [{field: value for field, value in zip(l_fields, row) if value is not COLUMN_MISSING} for row in l_rows]
+    else:
+        l_records = [dict(zip(l_fields, row)) for row in l_rows]
+    if arg_key_field is not None:
+        return {str(value): record for value, record in zip(arg_columns[arg_key_field], l_records) if value is not COLUMN_MISSING}
+    if COLUMNS_KEY in arg_columns:
+        return dict(zip(arg_columns[COLUMNS_KEY], l_records))
+    return l_records
+
 @typechecked
 def dict_add(arg_original: dict, arg_updated: dict, arg_let_original_values_be: bool = False) -> dict:
     ''' First dict is the original, the next arg is the new dict you want to add on top (overwriting keys that already exists)
@@ -454,9 +1621,69 @@ def dict_compare(d1: dict, d2: dict) -> dict:
     added = d2_keys - d1_keys
     removed = d1_keys - d2_keys
     modified = {o : (d1[o], d2[o]) for o in shared_keys if d1[o] != d2[o]}
-    same = set(o for o in shared_keys if d1[o] == d2[o])
+    same = shared_keys.difference(modified) # Comparing big values once is enough
     return {'added': added, 'removed': removed, 'modified': modified, 'same': same}
 
+@typechecked
+def dict_compare_deep(d1: Union[dict, list], d2: Union[dict, list]) -> List[Dict[str, Any]]:
+    ''' Same idea as dict_compare() but it goes down into nested dicts and lists and only returns what has changed, as a list that can be saved as JSON:
+        {"op": "added", "path": [...], "new": value}, {"op": "removed", "path": [...], "old": value} or {"op": "modified", "path": [...], "old": value, "new": value}
+        path is the keys and list indexes from the top. Lists are compared index by index. Use dict_apply_changes() to go from d1 to d2 (or back)
+    '''
+    res: List[Dict[str, Any]] = []
+    _dict_compare_deep(d1, d2, [], res)
+    return res
+
+def _dict_compare_deep(arg_old: Any, arg_new: Any, arg_path: List[Any], arg_res: List[Dict[str, Any]]) -> None:
+    ''' Internal function. Adds the changes from arg_old to arg_new to arg_res '''
+    if isinstance(arg_old, dict) and isinstance(arg_new, dict):
+        l_diff = dict_compare(arg_old, arg_new)
+        for key in arg_old: # The order of the keys in the file, the sets in l_diff have no order
+            if key in l_diff['removed']:
+                arg_res.append({"op": "removed", "path": arg_path + [key], "old": arg_old[key]})
+            elif key in l_diff['modified']:
+                _dict_compare_deep(arg_old[key], arg_new[key], arg_path + [key], arg_res)
+        for key in arg_new:
+            if key in l_diff['added']:
+                arg_res.append({"op": "added", "path": arg_path + [key], "new": arg_new[key]})
+    elif isinstance(arg_old, list) and isinstance(arg_new, list):
+        l_shared = min(len(arg_old), len(arg_new))
+        for i in range(l_shared):
+            if arg_old[i] != arg_new[i]:
+                _dict_compare_deep(arg_old[i], arg_new[i], arg_path + [i], arg_res)
+        for i in range(len(arg_old) - 1, l_shared - 1, -1): # From the end so the indexes are right when the changes are applied in order
+            arg_res.append({"op": "removed", "path": arg_path + [i], "old": arg_old[i]})
+        for i in range(l_shared, len(arg_new)):
+            arg_res.append({"op": "added", "path": arg_path + [i], "new": arg_new[i]})
+    elif arg_old != arg_new:
+        arg_res.append({"op": "modified", "path": arg_path, "old": arg_old, "new": arg_new})
+
+@typechecked
+def dict_apply_changes(arg_data: Union[dict, list], arg_changes: List[Dict[str, Any]], arg_reverse: bool = False) -> Any:
+    ''' Applies changes from dict_compare_deep(d1, d2) on d1 to get d2. With arg_reverse it goes from d2 back to d1
+        arg_data is changed in place, use the returned value since it is a new object if the whole thing was replaced
+    '''
+    for change in (reversed(arg_changes) if arg_reverse else arg_changes):
+        l_op = change["op"]
+        l_value = change.get("new")
+        if arg_reverse:
+            l_op = {"added": "removed", "removed": "added"}.get(l_op, l_op)
+            l_value = change.get("old")
+        if not change["path"]: # The type of the top object changed
+            arg_data = l_value
+            continue
+        l_node = arg_data
+        for key in change["path"][:-1]:
+            l_node = l_node[key]
+        l_key = change["path"][-1]
+        if "removed" == l_op:
+            del l_node[l_key]
+        elif "added" == l_op and isinstance(l_node, list):
+            l_node.insert(l_key, l_value)
+        else:
+            l_node[l_key] = l_value
+    return arg_data
+
 @typechecked
 def dict_sub(arg_original: dict, arg_updater: dict) -> dict:
     ''' Returns a new dict with the keys that are in arg_updater removed from arg_original '''
@@ -471,12 +1698,48 @@ def dict_sub(arg_original: dict, arg_updater: dict) -> dict:
 def dict_intersect(arg_left: dict, arg_right: dict) -> dict:
     return {key: arg_left[key] for key in arg_left if key in arg_right}
 
+SAFE_PATH_CACHE_SIZE = 64 * 1024 # How many results smart_filesystem_safe_path() remembers
+
 @typechecked
 def smart_filesystem_safe_path(arg_file_path: str,
                                arg_allow_swedish_chars: bool = False,
                                arg_fix_season_and_episodes: bool = True,
                                arg_replacement_char: str = '.') -> str:
     ''' Make a long and weird string into something that the OS likes more to handle '''
+    return _smart_filesystem_safe_path(arg_file_path, arg_allow_swedish_chars, arg_fix_season_and_episodes, arg_replacement_char)
+
+@typechecked
+def safe_paths(arg_file_paths: Iterable[str],
+               arg_allow_swedish_chars: bool = False,
+               arg_fix_season_and_episodes: bool = True,
+               arg_replacement_char: str = '.') -> List[str]:
+    ''' smart_filesystem_safe_path() on many paths. The arguments are only checked once '''
+    return [_smart_filesystem_safe_path(file_path, arg_allow_swedish_chars, arg_fix_season_and_episodes, arg_replacement_char) for file_path in arg_file_paths]
+
+@functools.lru_cache(maxsize=None) # Only a few different combinations of the arguments are used
+def _safe_path_rules(arg_allow_swedish_chars: bool, arg_fix_season_and_episodes: bool, arg_replacement_char: str) -> Tuple[List[Tuple[str, str]], List[Tuple[str, Any, str]]]:
+    ''' Internal function. The replacements (in order) and the compiled regexps that smart_filesystem_safe_path() uses.
+        Each regexp has a str that must be in the casefold() of the path for the regexp to match
+    '''
+    l_replacements = []
+    if not arg_allow_swedish_chars:
+        l_replacements += [("å", "a"), ("ä", "a"), ("ö", "o"), ("Å", "A"), ("Ä", "A"), ("Ö", "O")]
+    l_replacements += [("https://", ""), ("http://", "")]
+    l_replacements += [(char, arg_replacement_char) for char in "\\%:/?-#* "] # "_" is kept
+    l_replacements += [("｜", ""), ("：", ""), ("？", "")] # special chars that yt-dlp generate
+    l_replacements += [('"', ""), ("'", ""), ("[", arg_replacement_char), ("]", arg_replacement_char), ("\t", "")]
+    l_replacements += [(".–", arg_replacement_char), ("–.", arg_replacement_char)]
+
+    l_regexps: List[Tuple[str, Any, str]] = []
+    if arg_fix_season_and_episodes:
+        l_regexps.append(("song", re.compile(r's[aä]song.(\d\d?).avsnitt.(\d\d?)', flags=re.IGNORECASE), 'S0\\1E0\\2')) # Swedish naming: Säsong-1-avsnitt-1 --> S01E01
+        l_regexps.append(("s0", re.compile(fr'([{arg_replacement_char}])S0(\d\d)E(\d\d?\d?)', flags=re.IGNORECASE), '\\1S\\2E\\3')) # Fix Season numbers 'S011' --> 'S11'
+        l_regexps.append(("e0", re.compile(fr'([{arg_replacement_char}])S(\d\d)E0(\d\d)', flags=re.IGNORECASE), '\\1S\\2E\\3')) # Fix episode numbers 'E012' --> 'E12'
+    return l_replacements, l_regexps
+
+@functools.lru_cache(maxsize=SAFE_PATH_CACHE_SIZE)
+def _smart_filesystem_safe_path(arg_file_path: str, arg_allow_swedish_chars: bool, arg_fix_season_and_episodes: bool, arg_replacement_char: str) -> str:
+    ''' Internal function. Does the work for smart_filesystem_safe_path() '''
     res = str(arg_file_path)
 
     l_dir = ''
@@ -485,49 +1748,19 @@ def smart_filesystem_safe_path(arg_file_path: str,
         l_dir = os.path.dirname(arg_file_path)
         res = os.path.basename(arg_file_path)
 
-    if not arg_allow_swedish_chars:
-        res = res.replace("å", "a")
-        res = res.replace("ä", "a")
-        res = res.replace("ö", "o")
-        res = res.replace("Å", "A")
-        res = res.replace("Ä", "A")
-        res = res.replace("Ö", "O")
-
-    res = res.replace("https://", "")
-    res = res.replace("http://", "")
-    res = res.replace("\\", arg_replacement_char)
-    res = res.replace("%", arg_replacement_char)
-    res = res.replace(":", arg_replacement_char)
-    # res = res.replace("_", arg_replacement_char) # Keep underscore?
-    res = res.replace("/", arg_replacement_char)
-    res = res.replace("?", arg_replacement_char)
-    res = res.replace("-", arg_replacement_char)
-    res = res.replace("#", arg_replacement_char)
-    res = res.replace("*", arg_replacement_char)
-    res = res.replace(" ", arg_replacement_char)
-    res = res.replace("｜", "") # special char that yt-dlp generate
-    res = res.replace("：", "") # special char that yt-dlp generate
-    res = res.replace("？", "") # special char that yt-dlp generate
-    res = res.replace('"', "")
-    res = res.replace("'", "")
-    res = res.replace("[", arg_replacement_char)
-    res = res.replace("]", arg_replacement_char)
-    res = res.replace("\t", "")
-    res = res.replace(".–", arg_replacement_char)
-    res = res.replace("–.", arg_replacement_char)
+    l_replacements, l_regexps = _safe_path_rules(arg_allow_swedish_chars, arg_fix_season_and_episodes, arg_replacement_char)
+    for old, new in l_replacements:
+        if old in res: # Looking is much faster than replace() that creates a new str
+            res = res.replace(old, new)
 
-    if arg_fix_season_and_episodes:
-        res = re.sub(r's[aä]song.(\d\d?).avsnitt.(\d\d?)', 'S0\\1E0\\2', res, flags=re.IGNORECASE) # Swedish naming: Säsong-1-avsnitt-1 --> S01E01
-        res = re.sub(fr'([{arg_replacement_char}])S0(\d\d)E(\d\d?\d?)', '\\1S\\2E\\3', res, flags=re.IGNORECASE) # Fix Season numbers 'S011' --> 'S11'
-        res = re.sub(fr'([{arg_replacement_char}])S(\d\d)E0(\d\d)', '\\1S\\2E\\3', res, flags=re.IGNORECASE) # Fix episode numbers 'E012' --> 'E12'
+    for needle, regexp, replacement in l_regexps:
+        if needle in res.casefold(): # casefold() since re.IGNORECASE also matches chars like ſ (long s)
+            res = regexp.sub(replacement, res)
 
     res = os.path.join(l_dir, res)
-    while res != res.replace('__', arg_replacement_char):
-        res = res.replace('__', arg_replacement_char)
-    while res != res.replace('  ', arg_replacement_char):
-        res = res.replace('  ', arg_replacement_char)
-    while res != res.replace('..', arg_replacement_char):
-        res = res.replace('..', arg_replacement_char)
+    for double in ('__', '  ', '..'):
+        while double in res and double != arg_replacement_char: # Most of the time only once
+            res = res.replace(double, arg_replacement_char)
     return res
 
 @typechecked
@@ -562,50 +1795,232 @@ def get_size_as_B_KB_MB_GB(arg_size: Union[float, int], arg_force_unit: bool = F
 
     return f"{temp:0.2f} {units[-1]}"
 
-@typechecked
-def find_matching_brackets(arg_haystack: str, arg_opening_brackets: str = '{', arg_start_with_counter: int = 0):
-    closing_brackets_dict = {'[': ']', '{': '}', '(': ')', '<': '>'}
-    closing_brackets = closing_brackets_dict[arg_opening_brackets]
+_CLOSING_BRACKETS = {'[': ']', '{': '}', '(': ')', '<': '>'}
+_g_json_string = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', flags=re.DOTALL) # A JSON string literal, with \" inside
+
+@functools.lru_cache(maxsize=None)
+def _bracket_regexp(arg_opening_brackets: str, arg_skip_strings: bool) -> Any:
+    ''' Internal function. Finds the next bracket (or " if strings are skipped) so the text between is jumped over in C '''
+    return re.compile("[" + re.escape(arg_opening_brackets + _CLOSING_BRACKETS[arg_opening_brackets] + ('"' if arg_skip_strings else '')) + "]")
 
-    for i in range(0, len(arg_haystack)):
-        if arg_haystack[i] == arg_opening_brackets:
+def _find_closing_bracket(arg_haystack: str, arg_start: int, arg_opening_brackets: str = '{', arg_start_with_counter: int = 0, arg_skip_strings: bool = False) -> int:
+    ''' Internal function. Index of the closing bracket that makes the counter 0 again, starting at arg_start. -1 if it is not found.
+        Works on indexes in arg_haystack so nothing is copied. arg_skip_strings skips brackets inside "JSON strings"
+    '''
+    l_regexp = _bracket_regexp(arg_opening_brackets, arg_skip_strings)
+    l_pos = arg_start
+    while True:
+        l_match = l_regexp.search(arg_haystack, l_pos)
+        if not l_match:
+            return -1
+        l_char = l_match.group()
+        l_pos = l_match.end()
+        if '"' == l_char:
+            l_string = _g_json_string.match(arg_haystack, l_match.start())
+            if not l_string:
+                return -1
+            l_pos = l_string.end()
+        elif l_char == arg_opening_brackets:
             arg_start_with_counter += 1
-        elif arg_haystack[i] == closing_brackets:
+        else:
             arg_start_with_counter -= 1
             if 0 == arg_start_with_counter:
-                return arg_haystack[0:i+1]
-    # timestamped_print("ERROR! find_matching_brackets() failed to find anything")
-    return ""
+                return l_match.start()
+
+def _find_opening_bracket(arg_haystack: str, arg_end: int, arg_opening_brackets: str = '{', arg_start_with_counter: int = 1) -> int:
+    ''' Internal function. Goes back from arg_end (not included) and returns the index of the arg_start_with_counter:th bracket that is still open there.
+        Brackets that are closed before arg_end and brackets inside "JSON strings" are skipped. -1 if it is not found
+    '''
+    l_closing = _CLOSING_BRACKETS[arg_opening_brackets]
+    l_depth = 0
+    l_opening = l_closing_pos = l_quote = arg_end # The last found of each, they are only searched again when they have been passed
+    while True:
+        if l_opening >= arg_end:
+            l_opening = arg_haystack.rfind(arg_opening_brackets, 0, arg_end)
+        if l_closing_pos >= arg_end:
+            l_closing_pos = arg_haystack.rfind(l_closing, 0, arg_end)
+        if l_quote >= arg_end:
+            l_quote = arg_haystack.rfind('"', 0, arg_end)
+        arg_end = max(l_opening, l_closing_pos, l_quote)
+        if -1 == arg_end:
+            return -1
+        if arg_end == l_quote: # The end of a string, go back to the " that starts it
+            while True:
+                arg_end = arg_haystack.rfind('"', 0, arg_end)
+                if -1 == arg_end:
+                    return -1
+                l_backslash = arg_end
+                while l_backslash > 0 and '\\' == arg_haystack[l_backslash - 1]:
+                    l_backslash -= 1
+                if 0 == (arg_end - l_backslash) % 2: # Not \"
+                    break
+        elif arg_end == l_closing_pos:
+            l_depth += 1
+        elif l_depth:
+            l_depth -= 1
+        else:
+            arg_start_with_counter -= 1
+            if 0 == arg_start_with_counter:
+                return arg_end
 
 @typechecked
-def get_part_of_json(arg_haystack: str, arg_start_marker_regexp: str, arg_opening_brackets: str = '{', arg_start_with_counter: int = 0) -> str:
-    json_result = ""
+def find_matching_brackets(arg_haystack: str, arg_opening_brackets: str = '{', arg_start_with_counter: int = 0):
+    l_end = _find_closing_bracket(arg_haystack, 0, arg_opening_brackets, arg_start_with_counter)
+    if -1 == l_end:
+        # timestamped_print("ERROR! find_matching_brackets() failed to find anything")
+        return ""
+    return arg_haystack[0:l_end+1]
 
-    match = re.search(arg_start_marker_regexp, arg_haystack)
-    if match:
-        match_index = match.start()
-        # Let's backup until we get the part before the match included in the arg_start_marker_regexp
-        number_of_opening_brackets_left_to_find = arg_start_with_counter
-        for i in range(match_index, 0, -1):
-            if arg_haystack[i] == arg_opening_brackets:
-                number_of_opening_brackets_left_to_find -= 1
-                if 0 == number_of_opening_brackets_left_to_find:
-                    json_result = find_matching_brackets(arg_haystack[i:], arg_opening_brackets)
-    if len(json_result) > 0:
-        return json_result
+@typechecked
+def get_part_of_json(arg_haystack: str, arg_start_marker_regexp: Union[str, re.Pattern], arg_opening_brackets: str = '{', arg_start_with_counter: int = 0) -> str:
+    ''' The JSON around the first match of arg_start_marker_regexp. arg_start_with_counter is how many levels of arg_opening_brackets to go out from the match '''
+    json_result = get_parts_of_json(arg_haystack, arg_start_marker_regexp, arg_opening_brackets, arg_start_with_counter, arg_max_parts=1)
+    if json_result:
+        return json_result[0]
 
     error_print("get_part_of_json() failed to find anything")
     return ""
 
 @typechecked
-def concat_files(arg_folder: str, arg_list_of_files: list[str] | str, arg_dest_file: str):
+def get_parts_of_json(arg_haystack: str, arg_start_marker_regexp: Union[str, re.Pattern], arg_opening_brackets: str = '{', arg_start_with_counter: int = 1, arg_max_parts: int = 0) -> List[str]:
+    ''' All the JSON parts in arg_haystack (a HTML page for example) around the matches of arg_start_marker_regexp, in one pass.
+        arg_start_with_counter is how many levels of arg_opening_brackets to go out from the match to where the JSON starts.
+        Brackets inside "strings" in the JSON are skipped, so the match should not be in the middle of a string. Matches inside a part that is already found are skipped. arg_max_parts 0 means all
+    '''
+    res: List[str] = []
+    l_regexp = re.compile(arg_start_marker_regexp) if isinstance(arg_start_marker_regexp, str) else arg_start_marker_regexp
+    l_pos = 0
+    while (len(res) != arg_max_parts or 0 == arg_max_parts) and l_pos <= len(arg_haystack):
+        l_match = l_regexp.search(arg_haystack, l_pos)
+        if not l_match:
+            break
+        l_pos = l_match.end() if l_match.end() > l_match.start() else l_match.end() + 1
+        if arg_start_with_counter <= 0:
+            continue
+        l_start = l_match.start()
+        if arg_haystack.startswith(arg_opening_brackets, l_start): # The match itself can be the first bracket
+            l_start = l_start if 1 == arg_start_with_counter else _find_opening_bracket(arg_haystack, l_start, arg_opening_brackets, arg_start_with_counter - 1)
+        else:
+            if l_start > 0 and '"' == arg_haystack[l_start - 1]: # The match is the start of a string, for example pageProps without the "
+                l_start -= 1
+            l_start = _find_opening_bracket(arg_haystack, l_start, arg_opening_brackets, arg_start_with_counter)
+        if -1 == l_start:
+            continue
+        l_end = _find_closing_bracket(arg_haystack, l_start, arg_opening_brackets, arg_skip_strings=True)
+        if -1 == l_end:
+            continue
+        res.append(arg_haystack[l_start:l_end+1])
+        l_pos = max(l_pos, l_end + 1)
+    return res
+
+_COPY_CHUNK_SIZE = 64 * 1024 * 1024 # How many bytes concat_files() copies between progress reports
+
+def _copy_file_into(arg_source: str, arg_dest_fd: int, arg_dest_offset: int, arg_size: int, arg_hasher: Any, arg_progress: Callable[[int], None]) -> int:
+    ''' Internal function. Copies at most arg_size bytes of arg_source into the open file arg_dest_fd at arg_dest_offset. Returns the number of bytes copied,
+        less than arg_size if the file has become shorter. The kernel does the copy with os.copy_file_range() or os.sendfile() if it can,
+        otherwise (or if arg_hasher is set) it is done a chunk at a time here
+    '''
+    l_done = 0
+    os.lseek(arg_dest_fd, arg_dest_offset, os.SEEK_SET)
+    with open(arg_source, "rb") as f:
+        l_src_fd = f.fileno()
+        l_eof = False
+        if arg_hasher is None:
+            for l_copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+                if l_copy is None:
+                    continue
+                try:
+                    while l_done < arg_size:
+                        if l_copy is os.sendfile:
+                            l_copied = os.sendfile(arg_dest_fd, l_src_fd, l_done, min(_COPY_CHUNK_SIZE, arg_size - l_done))
+                        else:
+                            l_copied = l_copy(l_src_fd, arg_dest_fd, min(_COPY_CHUNK_SIZE, arg_size - l_done), l_done)
+                        if 0 == l_copied: # The file is shorter than it was when we started
+                            l_eof = True
+                            break
+                        l_done += l_copied
+                        arg_progress(l_copied)
+                    break
+                except OSError: # Not supported between these files (other file system, old kernel, ...), try the next way. What was copied is kept
+                    continue
+        if l_done >= arg_size or l_eof:
+            return l_done
+
+        f.seek(l_done)
+        with open(arg_dest_fd, "wb", closefd=False) as f_dest:
+            f_dest.seek(arg_dest_offset + l_done)
+            while l_done < arg_size: # Not more than arg_size even if the file has grown, the offsets of the other files depend on it
+                l_chunk = f.read(min(1024 * 1024, arg_size - l_done))
+                if not l_chunk:
+                    break
+                if arg_hasher is not None:
+                    arg_hasher.update(l_chunk)
+                f_dest.write(l_chunk)
+                l_done += len(l_chunk)
+                arg_progress(len(l_chunk))
+    return l_done
+
+@typechecked
+def concat_files(arg_folder: str, arg_list_of_files: list[str] | str, arg_dest_file: str, arg_workers: int = 1, arg_checksum: str = "", arg_progress: Union[Callable[[int, int], None], None] = None) -> Union[bool, str]:
+    ''' Writes the files, one after the other, to arg_dest_file. The kernel copies the data if it can (no file is read into memory).
+        arg_workers > 1 makes the destination file its full size first and then the files are copied in parallel, each one at its own offset.
+        arg_checksum is a hashlib name (for example "sha256") of a checksum calculated while copying, the hex digest is then returned instead of True.
+        The data must pass through Python to be hashed so arg_checksum copies one file at a time without the kernel copy.
+        arg_progress is called with (bytes copied, total bytes) as the copy goes on.
+        The sizes of the files are taken before the copy starts and no more than that is copied from each file. If a file becomes shorter,
+        the total is lowered so the last call has bytes copied == total bytes
+    '''
+    import hashlib # Imported here since it's only needed here
+
     if isinstance(arg_list_of_files, str):
         arg_list_of_files = list_from_str(arg_list_of_files)
 
+    l_sources = [os.path.join(arg_folder, file) for file in arg_list_of_files]
+    l_sizes = [os.path.getsize(source) for source in l_sources]
+    l_offsets = list(itertools.accumulate(l_sizes, initial=0))
+    l_hasher = hashlib.new(arg_checksum) if arg_checksum else None
+    l_lock = threading.Lock()
+    l_copied = [0, l_offsets[-1]] # Bytes copied, total bytes
+
+    def _progress(arg_num_bytes: int) -> None:
+        if arg_progress is None:
+            return
+        with l_lock:
+            l_copied[0] += arg_num_bytes
+            arg_progress(l_copied[0], l_copied[1])
+
+    def _file_done(arg_source: str, arg_size: int, arg_done: int) -> None:
+        if arg_done == arg_size:
+            return
+        warning_print(f'"{arg_source}" became shorter during the copy, {arg_done} of {arg_size} bytes were copied')
+        with l_lock:
+            l_copied[1] -= arg_size - arg_done
+            if arg_progress is not None:
+                arg_progress(l_copied[0], l_copied[1])
+
+    if arg_workers <= 1 or l_hasher is not None or len(l_sources) < 2:
+        with open(arg_dest_file, "wb") as f:
+            l_offset = 0 # What was really copied, so a file that became shorter does not leave a gap
+            for source, size in zip(l_sources, l_sizes):
+                l_done = _copy_file_into(source, f.fileno(), l_offset, size, l_hasher, _progress)
+                _file_done(source, size, l_done)
+                l_offset += l_done
+        return l_hasher.hexdigest() if l_hasher is not None else True
+
     with open(arg_dest_file, "wb") as f:
-        for file in arg_list_of_files:
-            with open(os.path.join(arg_folder, file), "rb") as f2:
-                f.write(f2.read())
+        f.truncate(l_offsets[-1])
+
+    def _copy_one(arg_index: int) -> None:
+        l_fd = os.open(arg_dest_file, os.O_WRONLY | getattr(os, "O_BINARY", 0)) # One handle for each copy since the copy uses the file position
+        try:
+            l_done = _copy_file_into(l_sources[arg_index], l_fd, l_offsets[arg_index], l_sizes[arg_index], None, _progress)
+        finally:
+            os.close(l_fd)
+        _file_done(l_sources[arg_index], l_sizes[arg_index], l_done) # The rest of its place in arg_dest_file is left as zeros
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=arg_workers) as pool:
+        for _ in pool.map(_copy_one, range(len(l_sources))): # Lets the first exception through
+            pass
     return True
 
 @typechecked
@@ -615,13 +2030,73 @@ def text_write_whole_file(arg_filename: str, arg_text: str) -> bool:
         fp.write(arg_text)
     return True
 
+_COMPRESSION_MAGIC = ((b"\x1f\x8b", "gzip"), (b"\xfd7zXZ\x00", "xz"), (b"\x28\xb5\x2f\xfd", "zstd"))
+_COMPRESSION_EXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".xz": "xz", ".zst": "zstd", ".zstd": "zstd"}
+
+@typechecked
+def file_compression(arg_filename: Union[str, pathlib.Path], arg_check_content: bool = True) -> str:
+    ''' Returns "gzip", "xz", "zstd" or "" if the file is not compressed.
+        The first bytes of the file are checked if arg_check_content is True and the file exists, otherwise the extension decides
+    '''
+    arg_filename = str(arg_filename) # This will handle pathlib.Path
+    if arg_check_content and os.path.isfile(arg_filename):
+        with open(arg_filename, "rb") as f:
+            l_head = f.read(6)
+        for l_magic, l_compression in _COMPRESSION_MAGIC:
+            if l_head.startswith(l_magic):
+                return l_compression
+        return ""
+    return _COMPRESSION_EXTENSIONS.get(os.path.splitext(arg_filename)[1].lower(), "")
+
+@typechecked
+def file_open(arg_filename: Union[str, pathlib.Path], arg_mode: str = "r", arg_compression: Union[str, None] = None, arg_newline: Union[str, None] = "\n") -> Any:
+    ''' Same as io.open() with UTF-8 but gzip, xz and zstd files are (de)compressed on the fly, a chunk at a time.
+        arg_mode is "r", "w", "a", "rb", "wb" or "ab". arg_compression None means: look at the content when reading and at the extension when writing
+        zstd needs: pip install zstandard
+    '''
+    arg_filename = str(arg_filename) # This will handle pathlib.Path
+    l_binary_mode = arg_mode.replace("b", "").replace("t", "") + "b"
+    if arg_compression is None:
+        arg_compression = file_compression(arg_filename, arg_check_content=arg_mode.startswith("r"))
+
+    if not arg_compression:
+        if "b" in arg_mode:
+            return io.open(arg_filename, l_binary_mode)
+        return io.open(arg_filename, arg_mode.replace("t", ""), encoding="utf-8", newline=arg_newline)
+
+    if "gzip" == arg_compression:
+        import gzip # Imported here since it's only needed here
+        l_raw = io.open(arg_filename, l_binary_mode)
+        l_file = gzip.GzipFile(filename="", mode=l_binary_mode, fileobj=l_raw, compresslevel=6) # filename="" so the name of a temp file is not saved in the gzip header
+        l_file.myfileobj = l_raw # GzipFile closes myfileobj when it is closed
+    elif "xz" == arg_compression:
+        import lzma # Imported here since it's only needed here
+        l_file = lzma.open(arg_filename, l_binary_mode)
+    elif "zstd" == arg_compression:
+        try:
+            import zstandard # Imported here since it's only needed here
+        except ImportError as err:
+            raise ImportError(f'"{arg_filename}" is zstd compressed, you need: pip install zstandard') from err
+        l_file = zstandard.open(arg_filename, l_binary_mode)
+    else:
+        raise ValueError(f'Unknown compression "{arg_compression}", must be one of: gzip, xz, zstd')
+
+    if "b" in arg_mode:
+        return l_file
+    return io.TextIOWrapper(l_file, encoding="utf-8", newline=arg_newline)
+
 @typechecked
 def text_read_whole_file(arg_filename_or_url: str) -> Union[str, None]:
     arg_filename_or_url = str(arg_filename_or_url) # This will handle pathlib.Path
     if arg_filename_or_url.lower().startswith("http"):
+        if HTTP_CACHE_DIR:
+            _cached = http_cache_get(arg_filename_or_url)
+            return text_read_whole_file(_cached) if _cached else None
         _tmp = download_file(arg_filename_or_url)
+        if DOWNLOAD_FAILED == _tmp:
+            return None
         res = text_read_whole_file(_tmp)
-        os.remove(_tmp)
+        file_delete(_tmp)
         return res
 
     if "-" == arg_filename_or_url:
@@ -629,10 +2104,63 @@ def text_read_whole_file(arg_filename_or_url: str) -> Union[str, None]:
 
     if not os.path.exists(arg_filename_or_url):
         return None
-    with io.open(file=arg_filename_or_url, mode="r", encoding="utf-8", newline="\n") as fp:
+    with file_open(arg_filename_or_url, "r") as fp: # Compressed files are decompressed
         r = fp.read()
     return r
 
+def _iter_lines_buffered(arg_file: Any, arg_offset: int) -> Iterator[Tuple[int, str]]:
+    ''' Internal function. Yields (byte offset, stripped line) from a binary file object that cannot be memory mapped (stdin, pipes and compressed files) '''
+    l_pos = 0
+    while l_pos < arg_offset: # Not all of these can seek so read past the start
+        l_skipped = arg_file.read(min(1024 * 1024, arg_offset - l_pos))
+        if not l_skipped:
+            return
+        l_pos += len(l_skipped)
+    for line in arg_file: # Only one line at a time is kept in memory
+        l_start = l_pos
+        l_pos += len(line)
+        l_line = line.decode("utf-8").strip()
+        if l_line:
+            yield l_start, l_line
+
+def _iter_lines_mmap(arg_filename: str, arg_offset: int) -> Iterator[Tuple[int, str]]:
+    ''' Internal function. Yields (byte offset, stripped line) from a memory mapped file. The OS pages the file in and out so the memory use stays flat '''
+    import mmap # Imported here since it's only needed here
+
+    with open(arg_filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as l_map:
+        l_size = len(l_map)
+        l_pos = arg_offset
+        while l_pos < l_size:
+            l_end = l_map.find(b"\n", l_pos)
+            if -1 == l_end:
+                l_end = l_size
+            l_line = l_map[l_pos:l_end].decode("utf-8").strip()
+            if l_line:
+                yield l_pos, l_line
+            l_pos = l_end + 1
+
+@typechecked
+def text_iter_lines(arg_filename: Union[str, pathlib.Path], arg_offset: int = 0, arg_with_offsets: bool = False, arg_use_mmap: bool = True) -> Iterator[Any]:
+    ''' Yields the stripped non-empty lines (UTF-8) in the file one at a time, the file is never read as a whole. "-" is stdin.
+        arg_offset is the byte offset where the reading starts and it should be the start of a line, used to resume an interrupted run.
+        arg_with_offsets yields (byte offset of the line, line) instead so the caller knows where to resume from.
+        Normal files are memory mapped if arg_use_mmap, compressed files are decompressed (the offsets are then in the decompressed data)
+    '''
+    arg_filename = str(arg_filename) # This will handle pathlib.Path
+    if "-" == arg_filename:
+        l_items = _iter_lines_buffered(sys.stdin.buffer, arg_offset)
+    elif arg_use_mmap and not file_compression(arg_filename) and os.path.getsize(arg_filename) > 0: # An empty file cannot be memory mapped
+        l_items = _iter_lines_mmap(arg_filename, arg_offset)
+    else:
+        with file_open(arg_filename, "rb") as f:
+            l_reader = f if isinstance(f, io.BufferedIOBase) else io.BufferedReader(f) # The zstandard reader cannot be read line by line
+            for l_offset, l_line in _iter_lines_buffered(l_reader, arg_offset):
+                yield (l_offset, l_line) if arg_with_offsets else l_line
+        return
+
+    for l_offset, l_line in l_items:
+        yield (l_offset, l_line) if arg_with_offsets else l_line
+
 @typechecked
 def math_nthroot(x: Union[int, float, decimal.Decimal], n: Union[int, float, decimal.Decimal]) -> decimal.Decimal:
     ''' Returns the n:th root of x. Example: x=729, n=3 --> 9 '''
@@ -661,7 +2189,11 @@ def list_from_str(arg_str: Union[str, List, Set, Tuple, None],
     return res
 
 @typechecked
-def table_from_html(arg_url: str) -> List[List[str]]:
+def table_from_html(arg_url: str, arg_streaming: bool = False) -> List[List[str]]:
+    ''' All rows (<tr>) with <td> cells in the page. arg_streaming uses table_iter_from_html() which does not need bs4 and is much faster on big pages '''
+    if arg_streaming:
+        return list(table_iter_from_html(arg_url))
+
     from bs4 import BeautifulSoup # Imported here since it's an external lib
 
     res: List[List[str]] = []
@@ -681,6 +2213,153 @@ def table_from_html(arg_url: str) -> List[List[str]]:
             res.append(row_list)
     return res
 
+class _TableParser(html.parser.HTMLParser):
+    ''' Internal class. Collects the rows of the tables in a HTML page while it is fed, without building a tree. Used by table_iter_from_html() '''
+
+    def __init__(self, arg_table: Union[int, str, None], arg_text_only: bool, arg_header_cells: bool):
+        super().__init__(convert_charrefs=False) # The entities are kept as they are in the page, unless arg_text_only
+        self._wanted_table = arg_table
+        self._text_only = arg_text_only
+        self._cell_tags = ("td", "th") if arg_header_cells else ("td",)
+        self._num_tables = 0
+        self._tables: List[bool] = [] # One for each open <table>: is it (inside) the table we want?
+        self._rows: List[Tuple[int, List[str], List[Any]]] = [] # Open <tr>: (number of open tables when it started, cells, its slot in _slots)
+        self._slots: collections.deque = collections.deque() # [cells or None] for each <tr> in the order they started, so a row of a nested table comes after the row around it
+        self._cells: List[Tuple[int, List[str]]] = [] # Open <td>: (number of open tables when it started, the parts of its content)
+        self.rows: List[List[str]] = [] # Finished rows, the caller empties this
+        self.done = False # The table we want has ended, there is no need to read more
+
+    def _wanted(self) -> bool:
+        return self._wanted_table is None or (bool(self._tables) and self._tables[-1])
+
+    def _add(self, arg_raw: str, arg_text: str) -> None:
+        for _, parts in self._cells: # Cells inside cells (a table in a table) also end up in the outer cell, just as in the page
+            parts.append(arg_text if self._text_only else arg_raw)
+
+    def _close_cells(self, arg_level: int) -> None:
+        while self._cells and self._cells[-1][0] >= arg_level:
+            _, parts = self._cells.pop()
+            l_value = "".join(parts)
+            l_value = " ".join(l_value.split()) if self._text_only else l_value.strip(" \t\n\r\x0b\x0c")
+            if self._rows and self._rows[-1][0] == arg_level:
+                self._rows[-1][1].append(l_value)
+
+    def _close_rows(self, arg_level: int) -> None:
+        while self._rows and self._rows[-1][0] >= arg_level:
+            self._close_cells(self._rows[-1][0])
+            _, cells, slot = self._rows.pop()
+            slot[0] = cells
+        while self._slots and self._slots[0][0] is not None: # Same order as find_all("tr"): a row is only given when all rows that started before it are done
+            l_cells = self._slots.popleft()[0]
+            if l_cells:
+                self.rows.append(l_cells)
+
+    def handle_starttag(self, tag, attrs):
+        l_level = len(self._tables)
+        if "table" == tag:
+            l_wanted = self._wanted_table is None or (bool(self._tables) and self._tables[-1]) or self._wanted_table == self._num_tables or self._wanted_table == dict(attrs).get("id")
+            self._num_tables += 1
+            self._add(self.get_starttag_text(), " ")
+            self._tables.append(l_wanted)
+            return
+        if "tr" == tag and self._wanted():
+            self._close_rows(l_level) # <tr> without </tr> before
+            self._add(self.get_starttag_text(), " ") # For the cell around this table if there is one
+            l_slot: List[Any] = [None]
+            self._slots.append(l_slot)
+            self._rows.append((l_level, [], l_slot))
+            return
+        if tag in self._cell_tags and self._rows and self._rows[-1][0] == l_level:
+            self._close_cells(l_level) # <td> without </td> before
+            self._add(self.get_starttag_text(), " ")
+            self._cells.append((l_level, []))
+            return
+        self._add(self.get_starttag_text(), " " if tag in ("br", "p", "div", "td", "th", "li") else "")
+
+    def handle_startendtag(self, tag, attrs):
+        self._add(self.get_starttag_text(), " " if "br" == tag else "")
+
+    def handle_endtag(self, tag):
+        l_level = len(self._tables)
+        if "table" == tag and self._tables:
+            self._close_rows(l_level)
+            l_was_wanted = self._tables.pop()
+            self._add(f"</{tag}>", " ")
+            if l_was_wanted and self._wanted_table is not None and not self._wanted():
+                self.done = True
+            return
+        if "tr" == tag and self._rows and self._rows[-1][0] == l_level:
+            self._close_rows(l_level)
+            self._add(f"</{tag}>", " ")
+            return
+        if tag in self._cell_tags and self._cells and self._cells[-1][0] == l_level:
+            self._close_cells(l_level)
+            self._add(f"</{tag}>", " ")
+            return
+        self._add(f"</{tag}>", "")
+
+    def handle_data(self, data):
+        self._add(data, data)
+
+    def handle_entityref(self, name):
+        self._add(f"&{name};", html.unescape(f"&{name};"))
+
+    def handle_charref(self, name):
+        self._add(f"&#{name};", html.unescape(f"&#{name};"))
+
+    def handle_comment(self, data):
+        self._add(f"<!--{data}-->", "")
+
+    def close(self):
+        super().close()
+        self._close_rows(0)
+
+@typechecked
+def table_iter_from_html(arg_url: str, arg_table: Union[int, str, None] = None, arg_text_only: bool = False, arg_header_cells: bool = False, arg_chunk_size: int = 1024 * 1024) -> Iterator[List[str]]:
+    ''' Same as table_from_html() but yields one row at a time while the page is read a chunk at a time, no tree of the page is built.
+        arg_table is the index (0 is the first <table> in the page) or the id of the table, None means all rows in the page.
+        arg_text_only gives the text in the cells instead of the HTML. arg_header_cells includes <th> cells.
+        arg_url can also be a file (compressed files are decompressed, see file_open())
+    '''
+    l_file = arg_url
+    l_tmp = None
+    if arg_url.lower().startswith("http"):
+        l_file = http_cache_get(arg_url) if HTTP_CACHE_DIR else download_file(arg_url)
+        if not l_file or DOWNLOAD_FAILED == l_file:
+            return
+        l_tmp = None if HTTP_CACHE_DIR else l_file
+    if not os.path.exists(l_file):
+        return
+
+    l_parser = _TableParser(arg_table, arg_text_only, arg_header_cells)
+    try:
+        with file_open(l_file, "r", arg_newline=None) as f:
+            while not l_parser.done:
+                l_chunk = f.read(arg_chunk_size)
+                if not l_chunk:
+                    l_parser.close()
+                    yield from l_parser.rows
+                    break
+                l_parser.feed(l_chunk)
+                yield from l_parser.rows
+                l_parser.rows.clear()
+    finally:
+        if l_tmp:
+            file_delete(l_tmp)
+
+@typechecked
+def table_from_html_to_csv(arg_url: str, arg_csv_filename: str, arg_table: Union[int, str, None] = None, arg_text_only: bool = True, arg_header_cells: bool = True) -> int:
+    ''' Saves the rows from table_iter_from_html() in a CSV file (UTF-8) as they are parsed. Returns the number of rows '''
+    import csv # Imported here since it's only needed here
+
+    res = 0
+    with io.open(arg_csv_filename, "w", encoding="utf-8", newline="") as f:
+        l_writer = csv.writer(f)
+        for row in table_iter_from_html(arg_url, arg_table, arg_text_only, arg_header_cells):
+            l_writer.writerow(row)
+            res += 1
+    return res
+
 # @typechecked
 # def html_unicode_to_entities(arg_text: str) -> str:
 #     '''Converts unicode to HTML entities.  For example '&' becomes '&amp;' TODO: This seems broken? Deprecate it'''
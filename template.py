@@ -15,16 +15,18 @@ __maintainer__ = "Harding"
 __email__ = "not.at.the.moment@example.com"
 __status__ = "Development"
 
-STRICT_TYPES = True # If you want to have stict type checking: pip install typeguard
+STRICT_TYPES = True # If you want to have stict type checking: pip install typeguard. The env var HARDING_UTILS_TYPECHECK=full|public|none decides how much is checked
 
-from typing import Union, Any, Dict, List
+from typing import Union, Any, Dict, List, Iterable
 import logging # TODO: Change to loguru? https://github.com/Delgan/loguru
 from types import ModuleType
 import harding_utils as hu
 try:
     if not STRICT_TYPES:
         raise ImportError("Skipping the import of typeguard reason: STRICT_TYPES == False")
-    from typeguard import typechecked
+    if not hu.STRICT_TYPES:
+        raise ImportError("Skipping the import of typeguard reason: harding_utils.STRICT_TYPES == False")
+    from harding_utils import typechecked # Same as typeguard.typechecked but follows harding_utils.TYPECHECK_MODE
 except:
     STRICT_TYPES = False
     from typing import TypeVar
@@ -63,7 +65,7 @@ def file_work(arg_file: str, arg_update: bool = False) -> str:
     return f"{arg_file} is done!"
 
 @typechecked
-def module_work(arg_files: List[str], arg_update: bool = False) -> List[str]:
+def module_work(arg_files: Iterable[str], arg_update: bool = False) -> List[str]:
     ''' This is all the work the module is doing '''
 
     _g_logger.info("Welcome to TODO: Template!")
@@ -84,21 +86,21 @@ def module_main(arg_argv: Union[Dict[str, Any], None] = None) -> List[str]:
     _g_logger.debug("arg_argv looks like:")
     _g_logger.debug(hu.dict_to_json_string_pretty(arg_argv))
 
-    l_files = []
+    l_files: Iterable[str] = []
     if "-" == arg_argv.get('files', [""])[0]:
-        l_files.append("-")
+        l_files = ["-"]
     else:
-        l_files = hu.adv_glob(arg_argv.get('files', ""), arg_argv.get('check_subfolders', False))
-
-    if not l_files:
-        error_msg: str = "arg_files[] is empty!"
-        _g_logger.critical(error_msg)
-        return [error_msg]
+        l_files = hu.iter_glob(arg_argv.get('files', ""), arg_argv.get('check_subfolders', False)) # Work starts on the first file as soon as it is found
 
     if debug_mode:
         _g_logger.debug("Entering debug mode")
 
-    return module_work(arg_files=l_files, arg_update=arg_argv.get('update', False))
+    l_res: List[str] = module_work(arg_files=l_files, arg_update=arg_argv.get('update', False))
+    if not l_res:
+        error_msg: str = "arg_files[] is empty!"
+        _g_logger.critical(error_msg)
+        return [error_msg]
+    return l_res
 
 if __name__ == "__main__":
     import argparse